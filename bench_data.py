@@ -0,0 +1,89 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Micro-benchmark for TextBatcher.next against the former per-sequence loop
+
+Use as:
+    python bench_data.py data/dev [--step_size=64] [--n_iter=200]
+
+- Both implementations are run from the same start positions and checked
+  to return identical (input, target) pairs before timing
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import argparse
+import time
+from data import TextBatcher
+
+def loop_next(data, idx, step_size):
+    """
+    Former implementation of TextBatcher.next (kept here for reference)
+    Returns tuple (input, target, next idx)
+    """
+    n = data.shape[0]
+    ret = np.zeros((step_size + 1, idx.shape[0], 1)).astype('int32')
+    next_idx = (idx + step_size + 1) % n
+
+    for i, j in enumerate(idx):
+        if j < next_idx[i]:
+            ret[:, i, 0] = data[j : next_idx[i]]
+        else:
+            d = n - j
+            ret[: d, i, 0] = data[j :]
+            ret[d :, i, 0] = data[: next_idx[i]]
+
+    return ret[: -1], ret[1 :], (next_idx - 1) % n
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('text_file'  , type = str)
+    parser.add_argument('--step_size', type = int, default = 64)
+    parser.add_argument('--n_iter'   , type = int, default = 200)
+    args = parser.parse_args()
+
+    s = args.step_size
+
+    print('batch_size'.rjust(10) + 'loop (ms)'.rjust(12)
+          + 'gather (ms)'.rjust(12) + 'speedup'.rjust(10))
+
+    for batch_size in [1, 16, 128, 1024, 4096]:
+        batcher = TextBatcher(args.text_file, batch_size)
+        data = batcher._data
+        idx = batcher._idx.copy()
+
+        i0, t0, _ = loop_next(data, idx, s)
+        i1, t1 = batcher.next(s)
+        assert np.array_equal(i0, i1) and np.array_equal(t0, t1), \
+               "Mismatching batches"
+
+        start = time.time()
+        for _ in range(args.n_iter):
+            _, _, idx = loop_next(data, idx, s)
+        t_loop = (time.time() - start) / args.n_iter
+
+        start = time.time()
+        for _ in range(args.n_iter):
+            batcher.next(s)
+        t_gather = (time.time() - start) / args.n_iter
+
+        print(str(batch_size).rjust(10)
+              + ('%.3f' % (1e3 * t_loop  )).rjust(12)
+              + ('%.3f' % (1e3 * t_gather)).rjust(12)
+              + ('%.1fx' % (t_loop / t_gather)).rjust(10))
+
+if __name__ == '__main__':
+    main()
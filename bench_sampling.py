@@ -0,0 +1,70 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Micro-benchmark for sampling.sample against the former per-row sampling of
+gen_text.py (float64 conversion, renormalization, and np.random.multinomial)
+
+Use as:
+    python bench_sampling.py [--n_iter=200]
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import argparse
+import time
+from sampling import sample
+
+def multinomial_sample(p_bi):
+    """
+    Former sampling of gen_text.py, applied row by row
+    """
+    ret = np.zeros(p_bi.shape[0], dtype = 'int32')
+    for b in range(p_bi.shape[0]):
+        p = np.float64(p_bi[b])
+        p[: -1] = p[: -1] / np.sum(p[: -1]) * (1 - p[-1])
+        ret[b] = np.random.multinomial(1, p).argmax()
+    return ret
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_iter', type = int, default = 200)
+    args = parser.parse_args()
+
+    cases = [('multinomial loop', multinomial_sample),
+             ('sample'          , lambda p: sample(p)),
+             ('sample T=0.8'    , lambda p: sample(p, temperature = 0.8)),
+             ('sample top_k=5'  , lambda p: sample(p, top_k = 5)),
+             ('sample top_p=0.9', lambda p: sample(p, top_p = 0.9))]
+
+    print('batch_size'.rjust(10)
+          + ''.join(name.rjust(18) for name, _ in cases) + '   (usec/call)')
+
+    for batch_size in [1, 16, 128, 1024]:
+        logit_bi = 3. * np.random.randn(batch_size, 27)
+        p_bi = np.exp(logit_bi) / np.exp(logit_bi).sum(axis = 1)[:, None]
+        p_bi = p_bi.astype('float32') # as output by the network
+
+        line = str(batch_size).rjust(10)
+        for _, f in cases:
+            start = time.time()
+            for _ in range(args.n_iter):
+                f(p_bi)
+            line += ('%.1f' % (1e6 * (time.time() - start)
+                               / args.n_iter)).rjust(18)
+        print(line)
+
+if __name__ == '__main__':
+    main()
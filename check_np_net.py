@@ -0,0 +1,96 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Parity check of NpNet (np_net.py) against inference Net on a trained
+workspace (needs Theano)
+
+Use as:
+    python check_np_net.py --workspace=some_dir [--batch_size=4] \
+                           [--n_steps=64] [--window=16] [--tol=1e-4]
+
+- Both nets are fed the same random input, first one step per call and then
+  in windows of --window steps per call, with states carried across calls
+- After every call, outputs of all steps and states (get_prev_states) must
+  agree within --tol (max absolute difference); the first mismatch is
+  reported with exit status 1
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import argparse
+import sys
+from collections import OrderedDict
+from net import Net
+from np_net import NpNet
+
+def compare(nets, input_tbi, window):
+    """
+    Feeds input_tbi in calls of window steps to both nets (states reset
+    first) and returns list of (max |diff| of outputs, of states) per call
+    """
+    fs = [net.compile_f_fwd_propagate(step_size = window) for net in nets]
+    for net in nets:
+        net.reset_prev_states()
+
+    diffs = []
+    for t in range(0, input_tbi.shape[0] - window + 1, window):
+        outputs = [f(input_tbi[t : t + window])[0] for f in fs]
+        states  = [net.get_prev_states() for net in nets]
+        diffs.append((np.abs(outputs[0] - outputs[1]).max(),
+                      np.abs(states[0] - states[1]).max()))
+    return diffs
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workspace', type = str, required = True)
+    parser.add_argument('--batch_size', type = int, default = 4)
+    parser.add_argument('--n_steps', type = int, default = 64)
+    parser.add_argument('--window', type = int, default = 16)
+    parser.add_argument('--tol', type = float, default = 1e-4)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    options = OrderedDict()
+    options['step_size']  = 1
+    options['batch_size'] = args.batch_size
+
+    nets = [Net  (options, None, args.workspace),
+            NpNet(options, None, args.workspace)]
+
+    input_dim = nets[0].dimensions()[0]
+    input_tbi = np.random.RandomState(args.seed).randint \
+                    (input_dim, size = (args.n_steps, args.batch_size, 1)) \
+                    .astype('int32')
+
+    ok = True
+    for name, window in [('step', 1), ('window', args.window)]:
+        diffs = compare(nets, input_tbi, window)
+        bad = [k for k, d in enumerate(diffs) if max(d) > args.tol]
+        d_out, d_state = np.max(diffs, axis = 0)
+        print(name.ljust(8) + ': %d calls, max |diff| output %.2e, state %.2e'
+              % (len(diffs), d_out, d_state))
+        if len(bad) > 0:
+            k = bad[0]
+            print('    mismatch at call %d (steps %d-%d): output %.2e, '
+                  'state %.2e' % ((k, k * window, (k + 1) * window - 1)
+                                  + diffs[k]))
+            ok = False
+
+    print('OK' if ok else 'FAILED')
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Atomic writing of parameter files (params*.npz), optionally in a background
+thread so that training only waits for the host copy of parameters
+
+- Files are written as file + '.tmp', fsync'ed, and renamed over file, so
+  a crash leaves either the previous or the new file, never a partial one
+- Use as
+      writer = CheckpointWriter()
+      writer.write(file, params) # params: dict { str : np.ndarray } that
+                                 # is not modified afterwards
+      (...)
+      writer.flush()             # before reading/removing written files
+  where an error in the background is re-raised by the next write/flush
+"""
+
+from __future__ import absolute_import, division, print_function
+from six.moves import queue
+
+import numpy as np
+import os
+import threading
+import time
+
+def write_params(file, params):
+    """
+    Writes params (dict { str : np.ndarray }) to file atomically
+    """
+    tmp_file = file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        # There is also savez_compressed, but parameter data
+        # doesn't offer much opportunities for compression
+        np.savez(f, **params)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_file, file)
+
+    # make the rename itself durable
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(file)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass # not supported on some platforms
+
+class CheckpointWriter:
+    def __init__(self, queue_size = 2):
+        """
+        Writes files handed to write() in a background thread, in order
+            [queue_size]    int     max number of pending files before
+                                    write() blocks
+        """
+        self._queue = queue.Queue(maxsize = queue_size)
+        self._error = None
+
+        self.last_write_time = 0. # sec taken by writer for last file
+        self.n_written       = 0
+
+        self._thread = threading.Thread(target = self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            file, params = self._queue.get()
+            try:
+                if self._error is None: # skip after an error until raised
+                    start = time.time()
+                    write_params(file, params)
+                    self.last_write_time = time.time() - start
+                    self.n_written += 1
+            except Exception as e: # re-raised from write() or flush()
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise e
+
+    def write(self, file, params):
+        """
+        Queues params to be written to file and returns time (sec) blocked
+        for a free slot in the queue
+        """
+        self._raise()
+        start = time.time()
+        self._queue.put((file, params))
+        return time.time() - start
+
+    def flush(self):
+        """
+        Blocks until all queued files are written and returns time blocked
+        """
+        start = time.time()
+        self._queue.join()
+        self._raise()
+        return time.time() - start
@@ -0,0 +1,67 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Script for compiling text files into pre-mapped binary corpora (see corpus.py)
+
+Use as:
+    python compile_corpus.py data/train data/dev data/test
+    python compile_corpus.py --verify data/train data/dev data/test
+    python compile_corpus.py --index data/train_shards
+
+- Writes data/train.corpus, etc., which TextBatcher/DataIter then open
+  instantly in place of the text files
+- Re-run whenever the text files change (stale corpora are rejected)
+- With --index, instead writes the shard index of each given directory so
+  that it can be used as a single text file (compile the shards first if
+  desired, e.g., python compile_corpus.py data/train_shards/*)
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+from corpus import compile_text, find_compiled, read_header, \
+                   verify_compiled, write_index
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files'   , nargs = '+', type = str)
+    parser.add_argument('--verify', action = 'store_true')
+    parser.add_argument('--index' , action = 'store_true')
+    args = parser.parse_args()
+
+    for file in args.files:
+        start = time.time()
+        if args.index:
+            names, lengths = write_index(file)
+            print(file.ljust(24) + str(sum(lengths)).rjust(12) + ' chars'
+                  + ('  %d shards  ' % len(names)).ljust(26)
+                  + ('(%.1f sec)' % (time.time() - start)))
+            continue
+        elif args.verify:
+            compiled_file = find_compiled(file)
+            assert compiled_file is not None, "No compiled corpus for " + file
+            header = read_header(compiled_file)
+            status = 'ok' if verify_compiled(compiled_file) else 'BAD CRC'
+        else:
+            header = compile_text(file)
+            status = 'compiled'
+
+        print(file.ljust(24) + str(header['length']).rjust(12) + ' chars'
+              + ('  crc32 %08x  ' % header['crc32']) + status.ljust(10)
+              + ('(%.1f sec)' % (time.time() - start)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Backends for reading text files as sequences of class indices 0-26
+corresponding to ' ', 'a', ..., 'z'
+
+- Objects returned by open_text support
+      len(corpus)
+      corpus.take(pos, mode = 'wrap') -> np.ndarray of same shape as pos
+  where pos is an integer np.ndarray of positions (any shape)
+- In-RAM mode reads and validates the whole file once (np.ndarray)
+- Memmap mode (LazyText) only maps the file; characters are transformed and
+  validated lazily for each gathered window, so memory use stays flat
+  regardless of file size and concurrent processes share the page cache
+- If a compiled corpus (text_file + '.corpus', see compile_text) exists, it
+  is mapped instead without any full scan, regardless of mmap mode
+- If a shared copy of text_file was placed in POSIX shared memory (SHM_DIR,
+  see share_text), it is attached to with zero copy before anything else,
+  so that concurrent training processes hold a single copy of the corpus
+- If text_file is a directory of shards with an index (see write_index), it
+  is opened as their concatenation (ShardedText), each shard being opened as
+  above; use mmap or compiled shards to avoid reading all shards into RAM
+
+Compiled corpus format (little-endian)
+    [0, HEADER_SIZE)    header (HEADER_DTYPE, zero-padded)
+    [HEADER_SIZE, ...)  uint8 [length] of class indices 0-26
+where the header holds the alphabet, length, histogram of class indices,
+CRC-32 of the data, and size/mtime of the source text file at compile time
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import hashlib
+import os
+import zlib
+
+ALPHABET     = b' abcdefghijklmnopqrstuvwxyz'
+INDEX_NAME   = 'index'
+SHM_DIR      = '/dev/shm/char-lm'
+MAGIC        = b'CHARLM01'
+COMPILED_SFX = '.corpus'
+HEADER_SIZE  = 512
+HEADER_DTYPE = np.dtype([('magic'    , 'S8'  ),
+                         ('length'   , '<u8' ),
+                         ('src_size' , '<u8' ),
+                         ('src_mtime', '<f8' ),
+                         ('crc32'    , '<u4' ),
+                         ('alphabet' , 'S27' ),
+                         ('hist'     , '<u8' , (27,))])
+
+def check_mapped(data):
+    assert data.min() >= 0 and data.max() <= 26, "Bad text file"
+
+class LazyText:
+    def __init__(self, file):
+        self._raw = np.memmap(file, dtype = '<i1', mode = 'r')
+
+    def __len__(self):
+        return self._raw.shape[0]
+
+    def take(self, pos, mode = 'wrap'):
+        # transform space/lowercase/uppercase to 0-26
+        ret = np.asarray(self._raw.take(pos, mode = mode)) % 32
+        check_mapped(ret)
+        return ret
+
+def source_stat(file):
+    """
+    Returns tuple (size, mtime) identifying the version of a text file
+    (or of the index for a directory of shards, or of its compiled corpus
+    if only that exists)
+    """
+    if os.path.isdir(file):
+        file = os.path.join(file, INDEX_NAME)
+    elif not os.path.exists(file) and os.path.exists(file + COMPILED_SFX):
+        file = file + COMPILED_SFX
+    return os.path.getsize(file), os.path.getmtime(file)
+
+def check_fresh(header, src_file):
+    if os.path.exists(src_file):
+        assert (header['src_size'], header['src_mtime']) == \
+               source_stat(src_file), \
+               "Stale compiled corpus (re-run compile_corpus.py or " \
+               "corpus_server.py) for " + src_file
+
+def write_compiled(corpus, out_file, src_file, chunk_size = 1 << 24):
+    """
+    Write given corpus object as compiled corpus (one-time full scan)
+        corpus      corpus object (see above)
+        out_file    str     path to compiled corpus
+        src_file    str     path to text file the corpus was opened from
+    Returns header (np.void of HEADER_DTYPE)
+    """
+    n = len(corpus)
+    assert n > 0, "Empty text file"
+
+    header = np.zeros(1, dtype = HEADER_DTYPE)[0]
+    header['magic']    = MAGIC
+    header['length']   = n
+    header['alphabet'] = ALPHABET
+    header['src_size'], header['src_mtime'] = source_stat(src_file)
+
+    hist = np.zeros(27, dtype = 'int64')
+    crc = 0
+
+    # write to temporary file and rename, so that a crash leaves no corpus
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(b'\0' * HEADER_SIZE)
+        for i in range(0, n, chunk_size):
+            pos = np.arange(i, min(i + chunk_size, n))
+            chunk = corpus.take(pos).astype('uint8')
+            hist += np.bincount(chunk, minlength = 27)
+            crc = zlib.crc32(chunk.tobytes(), crc)
+            f.write(chunk.tobytes())
+        header['hist']  = hist
+        header['crc32'] = crc & 0xffffffff
+        f.seek(0)
+        f.write(header.tobytes())
+    os.rename(tmp_file, out_file)
+    return header
+
+def compile_text(file, out_file = None):
+    """
+    Write compiled corpus for the given text file
+        file        str     path to text file
+        [out_file]  str     (default: file + COMPILED_SFX)
+    Returns header (np.void of HEADER_DTYPE)
+    """
+    if out_file is None:
+        out_file = file + COMPILED_SFX
+    return write_compiled(LazyText(file), out_file, file)
+
+def read_header(compiled_file):
+    """
+    Returns header (np.void of HEADER_DTYPE) of compiled corpus
+    """
+    header = np.fromfile(compiled_file, dtype = HEADER_DTYPE, count = 1)
+    assert header.shape[0] == 1 and header[0]['magic'] == MAGIC, \
+           "Bad compiled corpus"
+    header = header[0]
+    assert header['alphabet'] == ALPHABET, "Mismatching alphabet"
+    assert os.path.getsize(compiled_file) == HEADER_SIZE + header['length'], \
+           "Truncated compiled corpus"
+    return header
+
+def verify_compiled(compiled_file, chunk_size = 1 << 24):
+    """
+    Returns True if data in compiled corpus match its CRC-32 (full scan)
+    """
+    header = read_header(compiled_file)
+    data = map_compiled(compiled_file, header)
+    crc = 0
+    for i in range(0, data.shape[0], chunk_size):
+        crc = zlib.crc32(data[i : i + chunk_size].tobytes(), crc)
+    return (crc & 0xffffffff) == header['crc32']
+
+def map_compiled(compiled_file, header):
+    return np.memmap(compiled_file, dtype = 'uint8', mode = 'r',
+                     offset = HEADER_SIZE, shape = (int(header['length']),))
+
+def find_compiled(file):
+    """
+    Returns path to compiled corpus for the given file if exists, else None
+    - file may be either the text file or the compiled corpus itself
+    - Compiled corpus must not be older than the text file (if it exists)
+    """
+    if file.endswith(COMPILED_SFX):
+        return file
+    compiled_file = file + COMPILED_SFX
+    if not os.path.exists(compiled_file):
+        return None
+    check_fresh(read_header(compiled_file), file)
+    return compiled_file
+
+class ShardedText:
+    def __init__(self, shard_dir, mmap = False):
+        """
+        Concatenation of shards listed in shard_dir/INDEX_NAME
+        - Positions are global offsets into the concatenation, so windows
+          crossing shard boundaries continue into the next shard
+        """
+        names, lengths = read_index(shard_dir)
+        self._shards  = [open_text(os.path.join(shard_dir, name), mmap) \
+                         for name in names]
+        self._offsets = np.concatenate([[0], np.cumsum(lengths)]) # cumulative
+
+        for shard, name, length in zip(self._shards, names, lengths):
+            assert len(shard) == length, "Stale shard index for " + name
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def take(self, pos, mode = 'wrap'):
+        n = len(self)
+        pos = (pos % n) if mode == 'wrap' else np.clip(pos, 0, n - 1)
+
+        flat  = pos.ravel()
+        shard = np.searchsorted(self._offsets, flat, side = 'right') - 1
+
+        # gather from each shard touched at once
+        order = np.argsort(shard, kind = 'mergesort')
+        ks, starts = np.unique(shard[order], return_index = True)
+        stops = np.append(starts[1 :], flat.shape[0])
+
+        ret = np.empty(flat.shape[0], dtype = 'uint8')
+        for k, start, stop in zip(ks, starts, stops):
+            idx = order[start : stop]
+            ret[idx] = self._shards[k].take(flat[idx] - self._offsets[k])
+        return ret.reshape(pos.shape)
+
+def write_index(shard_dir):
+    """
+    Write shard_dir/INDEX_NAME listing all shards in shard_dir with lengths
+    (one "name length" per line, in order of concatenation)
+    - Shards are all files except the index, sorted by name; a compiled
+      corpus is listed only if its text file is absent
+    Returns tuple (names, lengths)
+    """
+    files = set(f for f in os.listdir(shard_dir)
+                if os.path.isfile(os.path.join(shard_dir, f))
+                and f != INDEX_NAME and not f.endswith('.tmp'))
+    names = sorted(f for f in files
+                   if not (f.endswith(COMPILED_SFX)
+                           and f[: -len(COMPILED_SFX)] in files))
+    assert len(names) > 0, "No shards in " + shard_dir
+
+    lengths = [len(open_text(os.path.join(shard_dir, name), mmap = True)) \
+               for name in names]
+    with open(os.path.join(shard_dir, INDEX_NAME), 'w') as f:
+        for name, length in zip(names, lengths):
+            f.write(name + ' ' + str(length) + '\n')
+    return names, lengths
+
+def read_index(shard_dir):
+    """
+    Returns tuple (names, lengths) from shard_dir/INDEX_NAME
+    """
+    names, lengths = [], []
+    with open(os.path.join(shard_dir, INDEX_NAME)) as f:
+        for line in [l.rstrip('\n') for l in f if l.strip() != '']:
+            name, length = line.rsplit(' ', 1)
+            names.append(name)
+            lengths.append(int(length))
+    assert len(names) > 0, "Empty shard index for " + shard_dir
+    return names, lengths
+
+def shared_path(file):
+    """
+    Returns path of the shared copy of file in SHM_DIR (whether exists or not)
+    """
+    path = os.path.abspath(file)
+    key = hashlib.md5(path.encode('utf-8')).hexdigest()[: 16]
+    return os.path.join(SHM_DIR, os.path.basename(path) + '_' + key
+                                 + COMPILED_SFX)
+
+def share_text(file):
+    """
+    Place a shared copy of the given text file (or compiled corpus, or
+    directory of shards) in SHM_DIR as a compiled corpus
+    Returns tuple (path of shared copy, header)
+    """
+    try:
+        os.makedirs(SHM_DIR)
+    except OSError:
+        assert os.path.isdir(SHM_DIR), "Cannot create " + SHM_DIR
+    path = shared_path(file)
+    return path, write_compiled(open_local_text(file, mmap = True), path, file)
+
+def unshare_text(file):
+    """
+    Remove the shared copy of the given file if exists
+    """
+    path = shared_path(file)
+    if os.path.exists(path):
+        os.remove(path)
+
+def open_text(file, mmap = False):
+    """
+    Return corpus object for the given text file
+        file    str     path to text file (or compiled corpus, or directory
+                        of shards with an index)
+        [mmap]  bool    map file lazily instead of reading it into RAM
+    """
+    path = shared_path(file)
+    if os.path.exists(path):
+        header = read_header(path)
+        check_fresh(header, file)
+        return map_compiled(path, header)
+    return open_local_text(file, mmap)
+
+def open_local_text(file, mmap = False):
+    """
+    Same as open_text, but ignores shared copies
+    """
+    if os.path.isdir(file):
+        return ShardedText(file, mmap)
+
+    compiled_file = find_compiled(file)
+    if compiled_file is not None:
+        corpus = map_compiled(compiled_file, read_header(compiled_file))
+    elif mmap:
+        corpus = LazyText(file)
+        assert len(corpus) > 0, "Empty text file"
+    else:
+        # transform space/lowercase/uppercase to 0-26
+        corpus = np.fromfile(file, dtype = '<i1') % 32
+        assert len(corpus) > 0, "Empty text file"
+        check_mapped(corpus)
+    return corpus
@@ -0,0 +1,75 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Script for placing corpora in POSIX shared memory (/dev/shm) for concurrent
+training processes on the same machine (see corpus.py)
+
+Use as:
+    python corpus_server.py data/train data/dev data/test
+
+- While this runs, TextBatcher/DataIter/EvalIter in any process attach to
+  the shared copies with zero copy instead of loading their own
+- Shared copies are removed on exit (Ctrl-C or SIGTERM); with --keep, the
+  script returns immediately and leaves them until reboot or --remove
+- Paths given here must refer to the same files as given to train.py
+  (e.g., --data_dir=data for data/train)
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import signal
+import time
+from corpus import share_text, unshare_text
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files'   , nargs = '+', type = str)
+    parser.add_argument('--keep'  , action = 'store_true')
+    parser.add_argument('--remove', action = 'store_true')
+    args = parser.parse_args()
+
+    if args.remove:
+        for file in args.files:
+            unshare_text(file)
+        return
+
+    for file in args.files:
+        start = time.time()
+        path, header = share_text(file)
+        print(file.ljust(24) + str(header['length']).rjust(12) + ' chars -> '
+              + path + (' (%.1f sec)' % (time.time() - start)))
+
+    if args.keep:
+        return
+
+    # turn SIGTERM into KeyboardInterrupt for cleanup
+    def on_sigterm(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    print('Serving (Ctrl-C to stop)')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for file in args.files:
+            unshare_text(file)
+        print('Removed shared copies')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Unigram/bigram/trigram statistics of corpora (see corpus.py)
+
+- Counts are computed chunk by chunk with np.bincount over a memmapped
+  corpus and cached next to the data as text_file + STATS_SFX, which is
+  recomputed only when the text file changes
+- n-gram entropies are conditional entropies of the next character given
+  the (n - 1) previous ones, i.e., the bpc of an n-gram model evaluated on
+  the same data it was counted on (an optimistic baseline)
+
+Use as:
+    from corpus_stats import get_stats, ngram_entropies
+    counts = get_stats('data/train')
+    h1, h2, h3 = ngram_entropies(counts) # bpc
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import os
+from corpus import open_text, source_stat, read_header, COMPILED_SFX
+
+STATS_SFX = '.stats.npz'
+MAX_ORDER = 3
+
+def count_ngrams(corpus, chunk_size = 1 << 22):
+    """
+    Returns list of np.ndarray's of int64 counts for n = 1, ..., MAX_ORDER
+        counts[n - 1]   [27]*n      (index [c_1]...[c_n] in reading order)
+    """
+    n = len(corpus)
+    counts = [np.zeros(27 ** k, dtype = 'int64') \
+              for k in range(1, 1 + MAX_ORDER)]
+
+    for i in range(0, n, chunk_size):
+        # include (MAX_ORDER - 1) previous characters for n-grams that end
+        # within this chunk
+        lo = max(0, i - (MAX_ORDER - 1))
+        chunk = corpus.take(np.arange(lo, min(i + chunk_size, n))) \
+                      .astype('int64')
+        skip = i - lo
+
+        code = np.zeros(chunk.shape[0], dtype = 'int64')
+        for k in range(1, 1 + MAX_ORDER):
+            # code[j] = n-gram ending at j (valid for j >= k - 1)
+            code[k - 1 :] = code[k - 2 : -1] * 27 + chunk[k - 1 :] \
+                            if k > 1 else chunk
+            start = max(skip, k - 1)
+            counts[k - 1] += np.bincount(code[start :], minlength = 27 ** k)
+
+    return [c.reshape((27,) * k) for k, c in enumerate(counts, 1)]
+
+def get_stats(file):
+    """
+    Returns counts as in count_ngrams for the given text file, using cache
+    - Any failure to read the cache (missing, stale, or half-written by
+      another process) is a cache miss, and failure to write it (e.g.,
+      read-only data directory) only skips caching
+    - Without the text file, the cache is keyed on its compiled corpus
+      (size, mtime, and CRC-32)
+    """
+    cache_file = file + STATS_SFX
+    src_size, src_mtime = source_stat(file)
+    src_crc = 0
+    if not os.path.exists(file) and os.path.exists(file + COMPILED_SFX):
+        src_crc = int(read_header(file + COMPILED_SFX)['crc32'])
+    try:
+        with np.load(cache_file) as cache:
+            if cache['src_size'] == src_size \
+                    and cache['src_mtime'] == src_mtime \
+                    and cache['src_crc'] == src_crc:
+                return [cache['count_' + str(k)] \
+                        for k in range(1, 1 + MAX_ORDER)]
+    except Exception: # IOError, BadZipFile, ValueError, KeyError, ...
+        pass
+
+    counts = count_ngrams(open_text(file, mmap = True))
+
+    # write to temporary file (unique per process, as concurrent training
+    # runs may all miss at once) and rename, so that readers never see a
+    # partial cache
+    tmp_file = cache_file + '.tmp' + str(os.getpid())
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, src_size = src_size, src_mtime = src_mtime,
+                     src_crc = src_crc,
+                     **{ 'count_' + str(k) : c \
+                         for k, c in enumerate(counts, 1) })
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError):
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return counts
+
+def entropy(count):
+    """
+    Returns entropy (bits) of the distribution given by counts (any shape)
+    """
+    p = count[count > 0].astype('float64') / np.sum(count)
+    return -np.sum(p * np.log2(p))
+
+def ngram_entropies(counts):
+    """
+    Returns list of conditional entropies (bpc) for n = 1, ..., MAX_ORDER
+        H(c_n | c_1, ..., c_{n-1}) = H(c_1, ..., c_n) - H(c_1, ..., c_{n-1})
+    where the latter uses n-gram counts marginalized over the last character
+    """
+    return [entropy(c) - (entropy(c.sum(axis = -1)) if c.ndim > 1 else 0.) \
+            for c in counts]
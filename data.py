@@ -15,6 +15,7 @@
 """
 Iterator class for time slices of sequence minibatches, where each sequence
 in the minibatch starts from a random position in the text file
+(or from shuffled disjoint spans covering the text file; see TextBatcher)
 
 - Creates time slices suitable for BPTT(h; h'), where
       h = window_size, h' = step_size (see doi:10.1162/neco.1990.2.4.490)
@@ -33,6 +34,7 @@ in the minibatch starts from a random position in the text file
 - Unless stopped explicitly inside the loop, iterates indefinitely
 - Upon each iteration, 
     - previous arrays are shifted by step_size to the left in time dimension
+      (by moving the window in a ring buffer; returned arrays are views)
     - new step_size amount of data are read and put on the right
     - forward propagation is performed starting from prev_states
     - prev_states are rewound to time index (step_size - 1)
@@ -41,6 +43,9 @@ in the minibatch starts from a random position in the text file
 - First few iterations may have zeros or irrelevant data on the left, but
   states will be reset when the real data starts and loss won't be calculated
   in or be propagated to the zero-padded/irrelevant region
+- EvalIter instead walks the whole file exactly once (see its docstring)
+- PrefetchIter is a drop-in for DataIter that assembles minibatches in a
+  background thread and reports time spent waiting on them
 
 Test:
 
@@ -57,72 +62,321 @@ for _ in range(8):
 
 from __future__ import absolute_import, division, print_function
 from six import Iterator # allow __next__ in Python 2
+from six.moves import queue
 
 import numpy as np
 from collections import OrderedDict
+from corpus import open_text
+import threading
+import time
 
 # make sure seed is set and saved before instantiating these for repeatability
 class TextBatcher:
-    def __init__(self, file, batch_size):
-        # transform space/lowercase/uppercase to 0-26
-        self._data = np.fromfile(file, dtype = '<i1') % 32
-        self._n = self._data.shape[0]
-
-        assert self._n > 0, "Empty text file"
-        assert min(self._data) >= 0 and max(self._data) <= 26, "Bad text file"
+    def __init__(self, file, batch_size, mmap = False, span_size = None):
+        """
+        Reads batch_size sequences from the text file, each starting from
+            (span_size is None) a random position drawn independently
+            (otherwise)         the start of a span of span_size frames
+        - In the latter mode, the text is partitioned into disjoint spans
+          (at a random phase per pass) that are handed to sequences in
+          shuffled order; once a sequence has read span_size frames, it
+          continues from the next span, and a new pass is shuffled when all
+          spans have been handed out
+        - With span_size a multiple of step_size, every frame is read exactly
+          once per pass, except for the (size % span_size) ones left out by
+          the phase of each pass; otherwise, spans overrun by < step_size
+        """
+        # see corpus.py for mmap
+        self._data = open_text(file, mmap)
+        self._n = len(self._data)
 
         self._batch_size = batch_size
-        self._idx = np.random.randint(self._n, size = batch_size)
+        self._span_size  = span_size
+
+        if span_size is None:
+            self._idx = np.random.randint(self._n, size = batch_size)
+        else:
+            self._n_spans = self._n // span_size
+            assert self._n_spans >= batch_size, "Too large span_size"
+            
+            # own RNG so that the sequence of spans only depends on the state
+            self._rng = np.random.RandomState \
+                            (np.random.randint(np.iinfo(np.int32).max))
+            self._spans = np.zeros(0, dtype = 'int64') # not yet handed out
+            self._idx   = self._next_spans(batch_size)
+            self._left  = np.full(batch_size, span_size, dtype = 'int64')
+
+    def _next_spans(self, k):
+        """
+        Returns start positions of next k spans, shuffling new passes
+        """
+        ret = self._spans[: k]
+        self._spans = self._spans[k :]
+
+        if ret.shape[0] < k:
+            phase = self._rng.randint(self._span_size)
+            self._spans = (phase + self._span_size
+                           * self._rng.permutation(self._n_spans))
+            ret = np.concatenate([ret, self._next_spans(k - ret.shape[0])])
+        return ret
 
     def next(self, step_size):
         """
         Returns tuple (input, target), where target is input 1 frame ahead
         """
-        ret = np.zeros((step_size + 1, self._batch_size, 1)).astype('int32')
-        next_idx = (self._idx + step_size + 1) % self._n
+        # [step_size + 1][batch_size][1] matrix of positions to gather,
+        # wrapped around the end of the text (mode = 'wrap' applies % n)
+        t = np.arange(step_size + 1)
+        pos = t[:, None, None] + self._idx[None, :, None]
 
-        for i, idx in enumerate(self._idx):
-            if idx < next_idx[i]:
-                ret[:, i, 0] = self._data[idx : next_idx[i]]
-            else:
-                d = self._n - idx
-                ret[: d, i, 0] = self._data[idx :]
-                ret[d :, i, 0] = self._data[: next_idx[i]]
-        
-        self._idx = (next_idx - 1) % self._n
+        ret = self._data.take(pos, mode = 'wrap').astype('int32')
+
+        self._idx = (self._idx + step_size) % self._n
+
+        if self._span_size is not None:
+            self._left -= step_size
+            done = np.nonzero(self._left <= 0)[0]
+            if done.shape[0] > 0:
+                self._idx [done] = self._next_spans(done.shape[0]) % self._n
+                self._left[done] = self._span_size
 
         return ret[: -1], ret[1 :]
 
     def size(self):
         return self._n
 
+    def get_state(self):
+        if self._span_size is None:
+            return self._idx.copy()
+        return (self._idx.copy(), self._left.copy(), self._spans.copy(),
+                self._rng.get_state())
+
+    def set_state(self, state):
+        if self._span_size is None:
+            self._idx = state.copy()
+        else:
+            idx, left, spans, rng_state = state
+            self._idx, self._left, self._spans = \
+                idx.copy(), left.copy(), spans.copy()
+            self._rng.set_state(rng_state)
+
+class PrefetchBatcher:
+    def __init__(self, batcher, queue_size):
+        """
+        Wraps a TextBatcher to assemble up to queue_size chunks ahead in a
+        background thread, giving the same sequence of chunks as batcher
+            batcher     TextBatcher
+            queue_size  int         max number of chunks prepared ahead
+        - Changing step_size discards prepared chunks and rewinds batcher to
+          the state after the last chunk handed out, as does an error in
+          batcher (re-raised by next)
+        """
+        assert queue_size > 0
+        self._batcher    = batcher
+        self._queue_size = queue_size
+        self._thread     = None
+        self._step_size  = None
+        self._state      = batcher.get_state() # after last chunk handed out
+        self._wait_time  = 0.
+
+    def _start(self, step_size):
+        self._step_size = step_size
+        self._queue     = queue.Queue(maxsize = self._queue_size)
+        self._stop      = threading.Event()
+        self._thread    = threading.Thread(target = self._work,
+                                           args   = (self._queue, self._stop,
+                                                     step_size))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self, q, stop, step_size):
+        while not stop.is_set():
+            try:
+                item = (self._batcher.next(step_size),
+                        self._batcher.get_state(), None)
+            except Exception as e: # re-raised from next()
+                item = (None, None, e)
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout = 0.1)
+                    break
+                except queue.Full:
+                    pass
+            if item[2] is not None:
+                return
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self._batcher.set_state(self._state)
+
+    def next(self, step_size):
+        if step_size != self._step_size or self._thread is None:
+            self.close()
+            self._start(step_size)
+
+        start = time.time()
+        chunk, state, e = self._queue.get()
+        self._wait_time += time.time() - start
+
+        if e is not None: # rewind to the last chunk handed out and re-raise
+            self.close()
+            raise e
+
+        self._state = state
+        return chunk
+
+    def size(self):
+        return self._batcher.size()
+
+    def wait_time(self):
+        """
+        Returns time (sec) spent blocked on chunks since last call
+        """
+        ret, self._wait_time = self._wait_time, 0.
+        return ret
+
 class DataIter(Iterator):
     def __iter__(self):
         return self
 
-    def __init__(self, text_file, window_size, step_size, batch_size):
+    def __init__(self, text_file, window_size, step_size, batch_size,
+                 mmap = False, span_size = None):
         self._window_size = window_size
         self.set_step_size(step_size)
         
-        self._data = TextBatcher(text_file, batch_size)
+        # see TextBatcher for span_size
+        self._data = TextBatcher(text_file, batch_size, mmap, span_size)
 
-        # buffers for last minibatch [time][batch][class index]
-        self._input  = np.zeros((window_size, batch_size, 1)).astype('int32')
-        self._target = np.zeros((window_size, batch_size, 1)).astype('int32')
+        # ring buffers for minibatches [time][batch][class index], of which
+        # [end - window_size, end) is the last minibatch; twice as long as
+        # window so that data are moved back only when end reaches the end
+        self._input  = np.zeros((2 * window_size, batch_size, 1)) \
+                         .astype('int32')
+        self._target = np.zeros((2 * window_size, batch_size, 1)) \
+                         .astype('int32')
+        self._end    = window_size
 
     def set_step_size(self, step_size):
         assert self._window_size >= step_size
         self._step_size = step_size
 
     def __next__(self):
+        w = self._window_size
         s = self._step_size
+        e = self._end
 
-        self._input [: -s] = self._input [s :]
-        self._target[: -s] = self._target[s :]
+        if e + s > 2 * w: # keep only the (w - s) frames still in use
+            self._input [: w - s] = self._input [e - (w - s) : e]
+            self._target[: w - s] = self._target[e - (w - s) : e]
+            e = w - s
 
-        self._input[-s :, :, :], self._target[-s :, :, :] = self._data.next(s)
+        self._input[e : e + s], self._target[e : e + s] = self._data.next(s)
+        self._end = e + s
 
-        return self._input, self._target
+        # contiguous views [window_size][batch_size][1]
+        return self._input[e + s - w : e + s], self._target[e + s - w : e + s]
     
     def size(self):
         return self._data.size()
+
+class PrefetchIter(DataIter):
+    def __init__(self, text_file, window_size, step_size, batch_size,
+                 mmap = False, span_size = None, queue_size = 4):
+        """
+        Drop-in for DataIter that assembles chunks in a background thread
+        (see PrefetchBatcher), giving identical batches for a given seed
+        """
+        super(PrefetchIter, self).__init__(text_file, window_size, step_size,
+                                           batch_size, mmap, span_size)
+        self._data = PrefetchBatcher(self._data, queue_size)
+
+    def wait_time(self):
+        """
+        Returns time (sec) the loop spent blocked on data since last call
+        """
+        return self._data.wait_time()
+
+    def close(self):
+        self._data.close()
+
+class EvalIter:
+    def __init__(self, text_file, window_size, batch_size, mmap = False):
+        """
+        Iterator for evaluating on a whole text file exactly once
+        - Use as
+              for input_tbi, target_tbi, step_size, reset in eval_iter:
+                  if reset:
+                      (reset prev_states of all lanes)
+                  (loop content)
+          where input/target are as in DataIter and loss is to be calculated
+          from the last step_size time indices; stops after one full pass
+        - The file is split into a remainder at the front, of less than
+          batch_size * window_size frames, and batch_size contiguous
+          stripes of equal length that is a multiple of window_size
+        - The remainder is evaluated first in one window per lane (each lane
+          covering remainder_size // batch_size frames, with the preceding
+          characters as warm-up context, zeros before the start of the file)
+          with step_size < window_size, from reset prev_states
+        - Stripes are then walked by one lane each, in windows with
+          step_size == window_size from reset prev_states, so that states
+          are carried over exactly from one window to the next (in Net's
+          training graph, step_size also sets where states are rewound to,
+          which is why partial windows are never followed by another
+          window without a reset)
+        - Every target frame is counted exactly once, except for the first
+          remainder_size % batch_size ones left out to make remainder lanes
+          equal (used as warm-up context only)
+        """
+        self._window_size = window_size
+        self._batch_size  = batch_size
+
+        self._data = open_text(text_file, mmap)
+        n_pairs = len(self._data) - 1
+
+        # stripe size is a multiple of window_size
+        w, b = window_size, batch_size
+        self._stripe_size = (n_pairs // (b * w)) * w
+        rem = n_pairs - b * self._stripe_size # < batch_size * window_size
+        self._rem_size = rem // b
+        assert self._stripe_size + self._rem_size > 0, \
+               "Text file too short for batch_size"
+
+        # input positions where remainder lanes end and stripes start
+        self._rem_end = (rem - b * self._rem_size
+                         + self._rem_size * np.arange(1, b + 1))
+        self._start = rem + self._stripe_size * np.arange(b)
+
+    def _window(self, start):
+        """
+        Returns tuple (input, target) of window beginning at start positions
+        """
+        t = np.arange(self._window_size + 1)
+        pos = t[:, None, None] + start[None, :, None]
+
+        ret = self._data.take(pos, mode = 'clip').astype('int32')
+        ret[pos < 0] = 0
+
+        return ret[: -1], ret[1 :]
+
+    def __iter__(self):
+        w = self._window_size
+
+        if self._rem_size > 0:
+            input_tbi, target_tbi = self._window(self._rem_end - w)
+            yield input_tbi, target_tbi, self._rem_size, True
+
+        for offset in range(0, self._stripe_size, w):
+            input_tbi, target_tbi = self._window(self._start + offset)
+            yield input_tbi, target_tbi, w, offset == 0
+
+    def size(self):
+        return len(self._data)
+
+    def n_frames(self):
+        """
+        Returns number of target frames counted in one full pass
+        """
+        return self._batch_size * (self._stripe_size + self._rem_size)
@@ -0,0 +1,147 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Ensemble of inference nets trained by train.py, mixing their softmax
+outputs into one output of the same form
+
+- Drop-in for an inference Net when used as
+      nets = [Net(options, None, 'workspace_dir_' + str(k)) for k in ...]
+      ens = Ensemble(nets, 'avg')
+      f_fwd_propagate = ens.compile_f_fwd_propagate()
+      output_tbi = f_fwd_propagate(input_tbi)[0]
+  where all nets share options['step_size'] and options['batch_size'];
+  each inference Net has its own random name prefix, so their graphs can
+  be connected into a single compiled function (one call per step for all
+  K models instead of K calls)
+- NpNet's are mixed on the host instead
+- Mixing modes
+      avg         sum_k w_k p_k                     (arithmetic mean)
+      loglinear   exp(sum_k w_k log p_k) / Z        (normalized geometric)
+  with weights w_k summing to 1 (equal if not given)
+- States are kept per net; get/set_prev_states concatenate them in the
+  order of nets
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+MIX_MODES = ['avg', 'loglinear']
+
+class Ensemble:
+    def __init__(self, nets, mix = 'avg', weights = None):
+        """
+            nets        list of Net (inference) or of NpNet
+            [mix]       str                 one of MIX_MODES
+            [weights]   list of float       per net (normalized to sum 1)
+        """
+        assert len(nets) > 0 and mix in MIX_MODES
+        assert all(net.dimensions() == nets[0].dimensions() for net in nets)
+        self._nets = nets
+        self._mix  = mix
+
+        weights = np.ones(len(nets)) if weights is None else \
+                  np.asarray(weights, dtype = 'float64')
+        assert weights.shape == (len(nets),) and np.all(weights >= 0.)
+        self._weights = (weights / weights.sum()).astype('float32')
+
+        # Theano Nets are combined in one graph
+        self._on_device = hasattr(nets[0], 'connect_inference_graph')
+
+    def _mix_outputs(self, outputs, lib):
+        """
+        Mixes list of output_tbi's with numpy or theano.tensor as lib
+        """
+        if self._mix == 'avg':
+            return sum(w * o for w, o in zip(self._weights, outputs))
+
+        s_tbi = sum(w * lib.log(o) for w, o in zip(self._weights, outputs))
+        e_tbi = lib.exp(s_tbi - s_tbi.max(axis = 2, keepdims = True))
+        return e_tbi / e_tbi.sum(axis = 2, keepdims = True)
+
+    def compile_f_fwd_propagate(self, step_size = None):
+        """
+        Returns callable of same signature as inference Net's
+            f(input_tbi) -> [output_tbi]
+        (see Net.compile_f_fwd_propagate for step_size)
+        """
+        if not self._on_device:
+            fs = [net.compile_f_fwd_propagate(step_size) for net in self._nets]
+            return lambda input_tbi: \
+                [self._mix_outputs([f(input_tbi)[0] for f in fs], np)]
+
+        import theano as th
+        import theano.tensor as tt
+
+        p_input_tbi = tt.itensor3(name = 'port_i_input')
+        outputs, updates = [], []
+        for net in self._nets:
+            p_output_tbi, prev_state_updates = \
+                net.connect_inference_graph(p_input_tbi, step_size)
+            outputs += [p_output_tbi]
+            updates += prev_state_updates
+
+        return th.function(inputs  = [p_input_tbi],
+                           outputs = [self._mix_outputs(outputs, tt)],
+                           updates = updates)
+
+    def compile_f_reorder_prev_states(self):
+        """
+        Returns callable of same signature as inference Net's
+            f(src_b) -> None
+        """
+        if not self._on_device:
+            fs = [net.compile_f_reorder_prev_states() for net in self._nets]
+            def f(src_b):
+                for f_net in fs:
+                    f_net(src_b)
+            return f
+
+        import theano as th
+        import theano.tensor as tt
+
+        p_src_b = tt.ivector(name = 'port_i_src')
+        updates = []
+        for net in self._nets:
+            updates += net.connect_reorder_graph(p_src_b)
+
+        return th.function(inputs  = [p_src_b],
+                           outputs = [],
+                           updates = updates)
+
+    def get_prev_states(self, lanes = None):
+        return np.concatenate([net.get_prev_states(lanes)
+                               for net in self._nets], axis = 1)
+
+    def set_prev_states(self, states_bk, lanes = None):
+        lo = 0
+        for net in self._nets:
+            hi = lo + net.state_dim()
+            net.set_prev_states(states_bk[:, lo : hi], lanes)
+            lo = hi
+        assert states_bk.shape[1] == lo
+
+    def reset_prev_states(self, lanes = None):
+        for net in self._nets:
+            net.reset_prev_states(lanes)
+
+    def state_dim(self):
+        return sum(net.state_dim() for net in self._nets)
+
+    def dimensions(self):
+        return self._nets[0].dimensions()
+
+    def n_weights(self):
+        return sum(net.n_weights() for net in self._nets)
@@ -0,0 +1,342 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Local HTTP server for text generation, keeping the compiled inference
+function warm and merging concurrent requests into shared batch lanes
+Model is set in gen_text.cfg as for gen_text.py (several MODEL lines make an
+ensemble if --mix is given)
+
+Use as:
+    python gen_server.py [--lanes=32] [--host=127.0.0.1] [--port=8000] \
+                         [--engine=numpy] [--mix=avg] [--temperature=1.] \
+                         [--top-k=some_number] [--top-p=some_number] \
+                         [--sessions=1024] [--spill-dir=some_dir]
+
+    curl -d '{"text": "some initial text", "n_chars": 256}' \
+        http://127.0.0.1:8000/generate
+    curl http://127.0.0.1:8000/stats
+
+- POST /generate takes JSON { "text" : str, ["n_chars" : int],
+  ["session" : str] } and returns JSON { "text" : generated str,
+  "latency" : sec, "queue_wait" : sec } (n_chars defaults to CHARS in
+  gen_text.cfg; empty text primes with ' ' unless continuing a session)
+- With "session", the request continues from the states at the end of the
+  session's last request (its generated text included) instead of zeroed
+  states, so only the new text is primed; requests of the same session
+  must not overlap (see sessions.py for the LRU cache of --sessions states
+  and spilling to --spill-dir)
+- GET /stats returns aggregate counts and chars/sec over time spent stepping
+  (and session cache counters)
+- Every step feeds one character per lane to a single compiled function
+  call: lanes still priming feed their next initial text character, the
+  others feed their last sampled character; requests waiting for a free
+  lane join (with zeroed states) at the next step
+- An error while stepping fails all active and pending requests with
+  status 500 (JSON { "error" : str }) and the server keeps serving
+"""
+
+from __future__ import absolute_import, division, print_function
+from six.moves import BaseHTTPServer, socketserver, queue
+
+import numpy as np
+import argparse
+import json
+import threading
+import time
+import traceback
+from gen_text import load_nets, read_cfg, check_models
+from ensemble import MIX_MODES
+from sessions import SessionStore
+from sampling import sample
+from collections import OrderedDict
+
+ALLOWED = ' abcdefghijklmnopqrstuvwxyz'
+
+class Request:
+    def __init__(self, text, n_chars, session = None):
+        self.itext    = [ord(c) % 32 for c in text] # [0] if empty at admission
+        self.n_chars  = n_chars
+        self.session  = session
+        self.n_fed    = 0  # number of initial text characters fed
+        self.out      = [] # sampled class indices
+        self.done     = threading.Event()
+        self.error    = None # str if generation failed
+        self.t_submit = time.time()
+        self.t_start  = None
+
+class Scheduler:
+    def __init__(self, net, f_fwd_propagate, n_lanes, sample_kwargs = {},
+                       store = None):
+        """
+        Steps all active requests together as lanes of f_fwd_propagate,
+        which must be compiled for step_size 1 and batch_size n_lanes
+            [sample_kwargs] dict            kwargs to sampling.sample
+            [store]         SessionStore    for requests with session
+        """
+        self._net     = net
+        self._store   = store
+        self._kwargs  = sample_kwargs
+        self._f       = f_fwd_propagate
+        self._lanes   = [None] * n_lanes # Request or None
+        self._pending = queue.Queue()
+        self._lock    = threading.Lock()
+
+        # aggregate stats
+        self.n_requests = 0
+        self.n_chars    = 0
+        self.n_steps    = 0
+        self.step_time  = 0.
+        self.latency    = 0.
+        self.n_errors   = 0 # failed steps
+
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, text, n_chars, session = None):
+        """
+        Blocks until generation is done and returns finished Request
+        """
+        req = Request(text, n_chars, session)
+        self._pending.put(req)
+        while not req.done.wait(1.):
+            if not self._thread.is_alive():
+                req.error = 'Scheduler stopped'
+                break
+        return req
+
+    def _admit(self, block):
+        joined = []
+        for k in range(len(self._lanes)):
+            if self._lanes[k] is not None:
+                continue
+            try:
+                idle = all(r is None for r in self._lanes)
+                req = self._pending.get(block = block and len(joined) == 0
+                                        and idle)
+            except queue.Empty:
+                break
+            req.t_start = time.time()
+            if req.n_chars <= 0:
+                self._finish(req)
+                continue
+            self._lanes[k] = req
+            joined.append(k)
+        if len(joined) == 0:
+            return
+
+        resumed = [k for k in joined if self._lanes[k].session is not None
+                                        and self._store is not None]
+        fresh   = [k for k in joined if k not in resumed]
+        if len(resumed) > 0:
+            contexts = self._store.load_lanes \
+                ([self._lanes[k].session for k in resumed], resumed)
+            for k, context in zip(resumed, contexts):
+                if context is not None:
+                    self._lanes[k].itext = context + self._lanes[k].itext
+        if len(fresh) > 0:
+            self._net.reset_prev_states(fresh)
+        for k in joined:
+            if len(self._lanes[k].itext) == 0:
+                self._lanes[k].itext = [0]
+
+    def _finish(self, req):
+        t = time.time()
+        with self._lock:
+            self.n_requests += 1
+            self.n_chars    += len(req.out)
+            self.latency    += t - req.t_submit
+        req.done.set()
+
+    def _fail(self, e):
+        """
+        Fails all active and pending requests with exception e
+        """
+        reqs = [r for r in self._lanes if r is not None]
+        self._lanes = [None] * len(self._lanes)
+        while True:
+            try:
+                reqs.append(self._pending.get(block = False))
+            except queue.Empty:
+                break
+        with self._lock:
+            self.n_errors += 1
+        for req in reqs:
+            req.error = type(e).__name__ + ': ' + str(e)
+            req.done.set()
+
+    def _run(self):
+        while True:
+            try:
+                self._step()
+            except Exception as e: # keep serving; clients get an error
+                traceback.print_exc()
+                self._fail(e)
+
+    def _step(self):
+        """
+        Admits pending requests and feeds one character to every lane
+        """
+        n = len(self._lanes)
+
+        # block for new requests only if all lanes are idle
+        self._admit(block = True)
+
+        i_b = np.zeros(n, dtype = 'int32')
+        for k, req in enumerate(self._lanes):
+            if req is None:
+                continue
+            i_b[k] = req.itext[req.n_fed] if req.n_fed < len(req.itext) \
+                     else req.out[-1]
+
+        start = time.time()
+        pred = self._f(i_b.reshape((1, n, 1)))
+        s_b = sample(pred[0][0], **self._kwargs)
+        with self._lock:
+            self.n_steps   += 1
+            self.step_time += time.time() - start
+
+        for k, req in enumerate(self._lanes):
+            if req is None:
+                continue
+            if req.n_fed < len(req.itext):
+                req.n_fed += 1
+            if req.n_fed == len(req.itext): # prediction for next char
+                req.out.append(s_b[k])
+                if len(req.out) == req.n_chars:
+                    if req.session is not None and self._store is not None:
+                        # last sampled character is not fed yet
+                        self._store.save_lanes([req.session], [k],
+                                               [[req.out[-1]]])
+                    self._lanes[k] = None
+                    self._finish(req)
+
+    def stats(self):
+        with self._lock:
+            ret = { 'requests'      : self.n_requests,
+                    'chars'         : self.n_chars,
+                    'steps'         : self.n_steps,
+                    'step_time'     : self.step_time,
+                    'chars_per_sec' : self.n_chars / max(self.step_time,
+                                                         1e-9),
+                    'mean_latency'  : self.latency / max(self.n_requests, 1),
+                    'active_lanes'  : sum(r is not None for r in self._lanes),
+                    'lanes'         : len(self._lanes),
+                    'errors'        : self.n_errors }
+            if self._store is not None:
+                ret['sessions'] = self._store.stats()
+            return ret
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    scheduler = None # set before serving
+    n_chars   = None
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.scheduler.stats())
+        else:
+            self._reply(404, { 'error' : 'Not found' })
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self._reply(404, { 'error' : 'Not found' })
+            return
+        try:
+            length = int(self.headers['Content-Length'])
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(body, dict):
+                raise ValueError('Not a JSON object')
+            text = str(body.get('text', '')).lower()
+            n_chars = int(body.get('n_chars', self.n_chars))
+            session = body.get('session')
+            session = str(session) if session is not None else None
+        except (TypeError, ValueError):
+            self._reply(400, { 'error' : 'Bad request' })
+            return
+        if any(c not in ALLOWED for c in text):
+            self._reply(400, { 'error' : "Only characters in '" + ALLOWED
+                                         + "' are allowed" })
+            return
+
+        req = self.scheduler.submit(text, n_chars, session)
+        if req.error is not None:
+            self._reply(500, { 'error' : req.error })
+            return
+        to_chr = lambda i: chr(i + 96) if i > 0 else ' '
+        self._reply(200, { 'text'       : ''.join(to_chr(i) for i in req.out),
+                           'latency'    : time.time() - req.t_submit,
+                           'queue_wait' : req.t_start - req.t_submit })
+
+    def log_message(self, format, *args):
+        pass # per-request latency is returned in responses instead
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lanes', type = int, default = 32)
+    parser.add_argument('--host' , type = str, default = '127.0.0.1')
+    parser.add_argument('--port' , type = int, default = 8000)
+    parser.add_argument('--engine', type = str, default = 'theano',
+                        choices = ['theano', 'numpy']) # see gen_text.py
+    parser.add_argument('--mix', type = str, choices = MIX_MODES)
+    parser.add_argument('--temperature', type = float, default = 1.)
+    parser.add_argument('--top-k', type = int)
+    parser.add_argument('--top-p', type = float)
+    parser.add_argument('--sessions', type = int, default = 1024)
+    parser.add_argument('--spill-dir', type = str)
+    args = parser.parse_args()
+
+    # read settings
+    models, n_chars = read_cfg()
+    check_models(parser, models, args.mix)
+
+    # initialize RNN
+    options = OrderedDict()
+    options['step_size']  = 1
+    options['batch_size'] = args.lanes
+
+    net = load_nets(args.engine, options, models, args.mix)
+    f_fwd_propagate = net.compile_f_fwd_propagate()
+
+    Handler.scheduler = Scheduler(net, f_fwd_propagate, args.lanes,
+                                  { 'temperature' : args.temperature,
+                                    'top_k'       : args.top_k,
+                                    'top_p'       : args.top_p },
+                                  SessionStore(net, args.sessions,
+                                               args.spill_dir))
+    Handler.n_chars   = n_chars
+
+    server = Server((args.host, args.port), Handler)
+    print('Serving ' + ', '.join(models)
+          + ' on http://%s:%d' % (args.host, args.port)
+          + ' with %d lanes (Ctrl-C to stop)' % args.lanes)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    main()
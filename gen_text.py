@@ -15,23 +15,170 @@
 """
 Script for generating text from models trained by train.py
 Set model path and number of characters to be generated in gen_text.cfg
+(several MODEL lines make an ensemble if --mix is given; see ensemble.py)
 
 Use as:
     python gen_text.py 'some initial text to initialize the states of RNNs'
-
+    python gen_text.py --num-samples=16 'some initial text'
+    python gen_text.py --engine=numpy 'some initial text'
+    python gen_text.py --temperature=0.8 --top-p=0.95 'some initial text'
+    python gen_text.py --beam=8 'some initial text'
+    python gen_text.py --fused 'some initial text'
+    python gen_text.py --mix=loglinear 'some initial text' # ensemble
+
+- With --engine=numpy, the NumPy-only engine (np_net.py) is used instead of
+  Theano, skipping Theano import and compilation
+- Sampling can be tuned with --temperature, --top-k, and --top-p (nucleus);
+  see sampling.py
+- With --num-samples=N, N independent samples are generated at once as the
+  batch lanes of a single compiled function, and printed one per line
+- With --beam=K, beam search keeps K hypotheses as batch lanes (instead of
+  sampling) and prints the K most likely continuations of CHARS characters
+  with their log-probabilities (natural log), most likely first
+- With --fused, all CHARS characters are sampled in a single call to a
+  function that feeds samples back on device (see Net.compile_f_sample);
+  only --temperature applies
+- Lines of gen_text.cfg starting with '#' are ignored; several MODEL lines
+  without --mix are an error, so that they never silently become an
+  ensemble
+- Initial text is fed in chunks of --prime-chunk characters per call to a
+  separately compiled multi-step function sharing the same states (see
+  prime), so that long initial texts take a few calls instead of one per
+  character
 """
 
 from __future__ import absolute_import, division, print_function
 
 import numpy as np
 import argparse
-from net import Net
+import sys
 from collections import OrderedDict
+from sampling import sample
+from ensemble import Ensemble, MIX_MODES
+
+def load_net(engine, options, model):
+    """
+    Returns inference Net (engine 'theano') or NpNet (engine 'numpy')
+    - Imported here so that the NumPy engine does not import Theano
+    """
+    if engine == 'numpy':
+        from np_net import NpNet
+        return NpNet(options, None, model)
+    assert engine == 'theano', "Invalid engine"
+    from net import Net
+    return Net(options, None, model)
+
+def check_models(parser, models, mix):
+    """
+    Reports through parser.error unless models (list of paths) is a single
+    model or an ensemble asked for with mix
+    """
+    if len(models) == 0:
+        parser.error('No MODEL in gen_text.cfg')
+    if len(models) > 1 and mix is None:
+        parser.error('%d models given; set --mix to ensemble them'
+                     % len(models))
+
+def load_nets(engine, options, models, mix = None):
+    """
+    Returns inference net for models (list of paths): Net or NpNet for a
+    single model, else Ensemble with mix (see check_models)
+    """
+    nets = [load_net(engine, options, model) for model in models]
+    if len(nets) == 1:
+        return nets[0]
+    assert mix is not None
+    print('Ensembling %d models (%s)' % (len(nets), mix), file = sys.stderr)
+    return Ensemble(nets, mix)
+
+def read_cfg(file = 'gen_text.cfg'):
+    """
+    Returns tuple (list of MODEL paths, CHARS) from gen_text.cfg, skipping
+    lines starting with '#'
+    """
+    models = []
+    n_chars = None
+    with open(file) as f:
+        for line in [l.rstrip('\n') for l in f]:
+            if line.lstrip().startswith('#'):
+                continue
+            if 'MODEL' in line:
+                models.append(line[line.find('=') + 1 :])
+            if 'CHARS' in line:
+                n_chars = int(line[line.find('=') + 1 :])
+    return models, n_chars
+
+def prime(net, f_fwd_propagate, itext, batch_size, chunk_size):
+    """
+    Feeds itext (list of class indices) to all lanes and returns the output
+    of the last step in the form of f_fwd_propagate's (step_size 1) output
+    - Full chunks go through a chunk_size step function compiled here,
+      the remainder through f_fwd_propagate, one character per call
+    """
+    n_chunks = len(itext) // chunk_size if chunk_size > 1 else 0
+    pred = None
+
+    if n_chunks > 0:
+        f_prime = net.compile_f_fwd_propagate(step_size = chunk_size)
+        for k in range(n_chunks):
+            chunk = np.array(itext[k * chunk_size : (k + 1) * chunk_size],
+                             dtype = 'int32')
+            pred = f_prime(np.tile(chunk[:, None, None], (1, batch_size, 1)))
+            pred = [pred[0][-1 :]]
+
+    for i in itext[n_chunks * chunk_size :]:
+        pred = f_fwd_propagate(np.full((1, batch_size, 1), i, dtype = 'int32'))
+    return pred
+
+def beam_search(f_fwd_propagate, f_reorder_prev_states, pred, n_chars):
+    """
+    Returns list of (log-probability, list of class indices) of the batch
+    size (= beam size) most likely continuations of n_chars characters,
+    most likely first
+        pred    output of f_fwd_propagate after priming all lanes alike
+    - Every step, the beam size best extensions of all hypotheses survive;
+      states are reordered on device by f_reorder_prev_states before the
+      chosen characters are fed
+    - Lanes start as copies of one hypothesis with log-probability
+      [0, -inf, ...] so that the first step only extends one of them
+    """
+    p_bi = pred[0][0]
+    k, n_classes = p_bi.shape
+
+    logp_b = np.full(k, -np.inf)
+    logp_b[0] = 0.
+    hyps = [[] for _ in range(k)]
+
+    for _ in range(n_chars):
+        with np.errstate(divide = 'ignore'):
+            score = (logp_b[:, None] + np.log(p_bi)).ravel()
+        best = np.argpartition(-score, k - 1)[: k]
+        best = best[np.argsort(-score[best])]
+
+        src_b, i_b = best // n_classes, (best % n_classes).astype('int32')
+        logp_b = score[best]
+        hyps = [hyps[src] + [i] for src, i in zip(src_b, i_b)]
+
+        f_reorder_prev_states(src_b.astype('int32'))
+        p_bi = f_fwd_propagate(i_b.reshape((1, k, 1)))[0][0]
+
+    return [(logp, hyp) for logp, hyp in zip(logp_b, hyps)
+                        if logp > -np.inf]
 
 def main():
     # clean input text
     parser = argparse.ArgumentParser()
     parser.add_argument('text' , type = str)
+    parser.add_argument('--num-samples', type = int, default = 1)
+    parser.add_argument('--engine', type = str, default = 'theano',
+                        choices = ['theano', 'numpy'])
+    parser.add_argument('--temperature', type = float, default = 1.)
+    parser.add_argument('--top-k', type = int)
+    parser.add_argument('--top-p', type = float)
+    parser.add_argument('--prime-chunk', type = int, default = 128)
+    parser.add_argument('--beam', type = int)
+    parser.add_argument('--fused', action = 'store_true')
+    parser.add_argument('--mix', type = str, choices = MIX_MODES)
     args = parser.parse_args()
 
     text = str(args.text).lower()
@@ -42,43 +189,64 @@ def main():
             return
 
     # read settings
-    model = None
-    n_chars = None
-    with open('gen_text.cfg') as f:
-        for line in [l.rstrip('\n') for l in f]:
-            if 'MODEL' in line:
-                model = line[line.find('=') + 1 :]
-            if 'CHARS' in line:
-                n_chars = int(line[line.find('=') + 1 :])
-    
+    models, n_chars = read_cfg()
+    check_models(parser, models, args.mix)
+    if args.fused and args.beam is None:
+        if args.top_k is not None or args.top_p is not None:
+            parser.error('--fused only supports --temperature')
+        if len(models) > 1:
+            parser.error('--fused does not support ensembles')
+
     # initialize RNN
+    n = args.num_samples if args.beam is None else args.beam
+    assert n > 0
+
     options = OrderedDict()
     options['step_size']  = 1
-    options['batch_size'] = 1
+    options['batch_size'] = n
 
-    net = Net(options, None, model)
+    net = load_nets(args.engine, options, models, args.mix)
     f_fwd_propagate = net.compile_f_fwd_propagate()
 
+    # same initial text for all lanes
     itext = [ord(c) % 32 for c in text]
-    for i in itext:
-        pred = f_fwd_propagate(np.int32(i).reshape((1,1,1)))
+    pred = prime(net, f_fwd_propagate, itext, n, args.prime_chunk)
 
-    print(text, end = '')
+    to_chr = lambda i: chr(i + 96) if i > 0 else ' '
 
-    # generate text
-    for _ in range(n_chars):
-        # using float32 as is leads to numpy throwing due to
-        # probability sum sometimes exceeding 1.0
-        p = np.float64(pred[0].flatten())
+    if args.beam is not None:
+        f_reorder_prev_states = net.compile_f_reorder_prev_states()
+        for logp, hyp in beam_search(f_fwd_propagate, f_reorder_prev_states,
+                                     pred, n_chars):
+            print('%.4f\t' % logp + text + ''.join(to_chr(i) for i in hyp))
+        return
 
-        # multinomial requires sum(p[: -1]) <= 1.0
-        p[: -1] = p[: -1] / np.sum(p[: -1]) * (1 - p[-1])
-        i = np.random.multinomial(1, p).argmax()
+    if args.fused:
+        f_sample = net.compile_f_sample(n_chars, args.temperature)
+        sample_tb, pred = f_sample(pred[0])
+        for k in range(n):
+            print(text + ''.join(to_chr(i) for i in sample_tb[:, k]))
+        return
 
-        print(chr(i + 96) if i > 0 else ' ', end = '')
-        pred = f_fwd_propagate(np.int32(i).reshape((1,1,1)))
+    if n == 1:
+        print(text, end = '')
 
-    print('')
+    # generate text
+    samples = []
+    for _ in range(n_chars):
+        i_b = sample(pred[0][0], args.temperature,
+                     args.top_k, args.top_p) # [batch_size]
+        samples.append(i_b)
+
+        if n == 1:
+            print(to_chr(i_b[0]), end = '')
+        pred = f_fwd_propagate(i_b.reshape((1, n, 1)))
+
+    if n == 1:
+        print('')
+    else:
+        for k in range(n):
+            print(text + ''.join(to_chr(i_b[k]) for i_b in samples))
 
 if __name__ == '__main__':
     main()
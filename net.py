@@ -22,16 +22,19 @@ from six import iterkeys, itervalues, iteritems
 import cPickle as pk
 from collections import OrderedDict
 import os
+import time
 
 from layers import FCLayer, OneHotLayer, LSTMLayer, GRULayer, RHNLayer
 from utils import l2_loss, l1_loss, huber_loss, crossentropy_loss, \
                   clip_norm, get_random_string
+from checkpoint import write_params, CheckpointWriter
 from optimizers import sgd_update, momentum_update, nesterov_update, \
                        vanilla_force, adadelta_force, rmsprop_force, adam_force
 
 import numpy as np
 import theano as th
 import theano.tensor as tt
+from theano.sandbox.rng_mrg import MRG_RandomStreams
 
 class Slice():
     def __init__(self, start, stop, context_name = None):
@@ -67,10 +70,21 @@ class Slice():
         return ((full_size if self._rng.stop  is None else self._rng.stop )
               - (0         if self._rng.start is None else self._rng.start))
 
+    def localize(self, lanes, full_size):
+        """
+        Returns tuple (where, local) for np.ndarray of full batch indices
+        lanes, where lanes[where] are in this slice at local indices local
+        """
+        start = 0         if self._rng.start is None else self._rng.start
+        stop  = full_size if self._rng.stop  is None else self._rng.stop
+        where = np.nonzero((lanes >= start) & (lanes < stop))[0]
+        return where, lanes[where] - start
+
 
 class Net():
     def __init__(self, options,
-                       save_to = None, load_from = None, c_names = None):
+                       save_to = None, load_from = None, c_names = None,
+                       fused_update = False, async_save = False):
         """
         Mode is determined by whether save_to is None or not
 
@@ -83,6 +97,12 @@ class Net():
             <save_to>   str         'workspace_dir'
             [load_from] str         'workspace_dir' (if re-annealing)
                         NoneType    (if training fresh)
+            [fused_update] bool     compile_f_fwd_bwd_update instead of
+                                    compile_f_fwd_bwd_propagate and
+                                    compile_f_update_v_params (gradients
+                                    are not stored in shared variables)
+            [async_save] bool       write files of save_to_workspace in a
+                                    background thread (see checkpoint.py)
         (inference)
             (save_to)   NoneType    (leave as none)
             <load_from> str         'workspace_dir'
@@ -91,6 +111,10 @@ class Net():
               must be specified
         """
         self._configure(options, save_to, load_from, c_names)
+        self._fused_update = self._is_training and fused_update
+        self._snapshots = OrderedDict() # { name : OrderedDict of np.ndarray }
+        self._writer = CheckpointWriter() \
+                       if self._is_training and async_save else None
         self._init_params(load_from)
         self._init_shared_variables()
         if self._is_training:
@@ -219,7 +243,7 @@ class Net():
                       .astype('float32')
                 s.v_prev_states[k] = th.shared(v, name = dev + k, **s.device)
 
-        if self._is_training:
+        if self._is_training and not self._fused_update:
             self._v_grads = \
                 [th.shared(v * 0., name = k + '_grad', **self._device) \
                  for k, v in iteritems(self._params)]
@@ -274,27 +298,50 @@ class Net():
         """
         p_input_tbi = tt.itensor3(name  = 'port_i_input')
         
+        p_output_tbi, self._prev_state_updates = \
+            self.connect_inference_graph(p_input_tbi,
+                                          self._options['step_size'])
+
+        self._prop_i_ports   = [p_input_tbi]
+        self._prop_o_ports   = [p_output_tbi]
+
+    def connect_inference_graph(self, p_input_tbi, step_size = None):
+        """
+        Connect given input port to the inference graph of step_size time
+        steps (options['step_size'] if None) and return tuple
+            (p_output_tbi, prev_state_updates)
+        - Graphs of any step_size share v_params and v_prev_states
+        - Public so that graphs of several Nets can be combined (ensemble.py)
+        """
+        assert not self._is_training
+        if step_size is None:
+            step_size = self._options['step_size']
+
         # step_size is a compile time constant for inference
-        s_next_prev_idx = tt.alloc(np.int32(self._options['step_size'] - 1))
+        self._set_n_steps(step_size)
+        s_next_prev_idx = tt.alloc(np.int32(step_size - 1))
 
         outputs = []
-        self._prev_state_updates = []
+        prev_state_updates = []
 
         for s in self._slices:
-            s_output_tbi, prev_state_updates = self._setup_forward_graph \
+            s_output_tbi, updates = self._setup_forward_graph \
                 (s_input_tbi     = s.apply(p_input_tbi),
                  s_time_tb       = None,
                  s_next_prev_idx = s.transfer(s_next_prev_idx),
                  v_params        = s.v_params,
                  v_prev_states   = s.v_prev_states)
             outputs += [self.transfer(s_output_tbi)]
-            self._prev_state_updates += prev_state_updates
+            prev_state_updates += updates
+
+        self._set_n_steps(self._options['window_size']) # as in add_param
 
         # merge outputs from all slices
-        p_output_tbi = tt.concatenate(outputs, axis = 1)
+        return tt.concatenate(outputs, axis = 1), prev_state_updates
 
-        self._prop_i_ports   = [p_input_tbi]
-        self._prop_o_ports   = [p_output_tbi]
+    def _set_n_steps(self, n_steps):
+        for layer in self._layers:
+            layer.n_steps = n_steps
 
     def _setup_loss_graph(self, s_output_tbi, s_target_tbi, s_step_size):
         """
@@ -412,11 +459,17 @@ class Net():
         # sum losses and grads from all slices
         p_loss = sum(losses)
         s_new_grads = [sum(grad_tuple) for grad_tuple in zip(*gradss)]
-        self._grad_updates = [u for u in zip(self._v_grads, s_new_grads)]
+        if self._fused_update:
+            # optimizer reads new gradients directly in the same function
+            self._grad_updates = []
+            v_grads = s_new_grads
+        else:
+            self._grad_updates = [u for u in zip(self._v_grads, s_new_grads)]
+            v_grads = self._v_grads
 
         self._optim_inits, self._optim_param_updates, s_increments = \
             self._setup_optimizer_graph(s_lr    = self.transfer(p_lr),
-                                        v_grads = self._v_grads)
+                                        v_grads = v_grads)
 
         for s in self._slices:
             self._optim_param_updates += \
@@ -426,7 +479,7 @@ class Net():
         self._prop_o_ports   = [p_loss]
         self._update_i_ports = [p_lr]
 
-    def compile_f_fwd_propagate(self):
+    def compile_f_fwd_propagate(self, step_size = None):
         """
         Compile a callable object of signature
             (training)  f(input_tbi, target_tbi, step_size) -> [loss]
@@ -436,13 +489,132 @@ class Net():
         
         - Output is a list of np.ndarray (i.e., 0-th element is np.ndarray)
           whether scalar (loss) or tensor3 (output_tbi)
+        - For inference, giving step_size compiles a separate graph taking
+          input_tbi of step_size time steps instead of options['step_size'],
+          which shares v_params and v_prev_states with the default one
+          (e.g., for priming states with long text in few calls)
         """
         on_unused_input = 'raise' # 'ignore'
+        if step_size is not None and step_size != self._options['step_size']:
+            assert not self._is_training
+            p_input_tbi = tt.itensor3(name = 'port_i_input')
+            p_output_tbi, prev_state_updates = \
+                self.connect_inference_graph(p_input_tbi, step_size)
+            return th.function(inputs  = [p_input_tbi],
+                               outputs = [p_output_tbi],
+                               updates = prev_state_updates,
+                               on_unused_input = on_unused_input)
+
         return th.function(inputs  = self._prop_i_ports,
                            outputs = self._prop_o_ports,
                            updates = self._prev_state_updates,
                            on_unused_input = on_unused_input)
 
+    def compile_f_sample(self, n_chars, temperature = 1., seed = None):
+        """
+        Compile a callable object of signature
+            f(pred_tbi) -> [sample_tb, pred_tbi]
+        As a side effect, calling it updates
+            v_prev_states, random state
+        
+        - Samples n_chars characters per lane entirely on device: an outer
+          th.scan draws a character from pred (output of the last step,
+          [1][batch_size][target_dim]) and feeds it back through the one
+          step forward graph, n_chars times
+        - Returns sampled class indices (int32 [n_chars][batch_size]) and
+          output of the last step to be passed to the next call
+        - Sampling is from pred ** (1 / temperature) (normalized);
+          see sampling.py for top-k/top-p, which are done on the host
+        """
+        assert not self._is_training
+        p_pred_tbi = tt.tensor3(name = 'port_i_pred', dtype = 'float32')
+
+        srng = MRG_RandomStreams(seed if seed is not None else
+                                 np.random.randint(np.iinfo(np.int32).max))
+        keys = list(iterkeys(self._prev_dims))
+
+        self._set_n_steps(1)
+        s_zero_idx = tt.alloc(np.int32(0))
+
+        samples, preds, updates = [], [], OrderedDict()
+        for s in self._slices:
+            def step(pred_bi, *prev_states):
+                if temperature != 1.:
+                    pred_bi = pred_bi ** np.float32(1. / temperature)
+                    pred_bi = pred_bi / pred_bi.sum(axis = 1, keepdims = True)
+                onehot_bi = srng.multinomial(pvals = pred_bi,
+                                             dtype = 'float32')
+                i_b = tt.argmax(onehot_bi, axis = 1).astype('int32')
+
+                s_output_tbi, prev_state_updates = self._setup_forward_graph \
+                    (s_input_tbi     = i_b.reshape((1, -1, 1)),
+                     s_time_tb       = None,
+                     s_next_prev_idx = s.transfer(s_zero_idx),
+                     v_params        = s.v_params,
+                     v_prev_states   = OrderedDict(zip(keys, prev_states)))
+
+                # updates are in the order of layers, hence of keys
+                return [i_b, s_output_tbi[0]] + \
+                       [u[1] for u in prev_state_updates]
+
+            s_pred_bi = s.apply(p_pred_tbi)[0]
+            results, scan_updates = th.scan(step,
+                outputs_info = [None, s_pred_bi] + \
+                               [s.v_prev_states[k] for k in keys],
+                n_steps      = n_chars,
+                name         = self._pfx + 'sample_scan')
+
+            samples += [self.transfer(results[0])]
+            preds   += [self.transfer(results[1][-1 :])]
+            updates.update(scan_updates) # random state
+            for k, s_state_tbk in zip(keys, results[2 :]):
+                updates[s.v_prev_states[k]] = s_state_tbk[-1]
+
+        self._set_n_steps(self._options['window_size']) # as in add_param
+
+        # merge outputs from all slices
+        return th.function(inputs  = [p_pred_tbi],
+                           outputs = [tt.concatenate(samples, axis = 1),
+                                      tt.concatenate(preds  , axis = 1)],
+                           updates = updates)
+
+    def compile_f_reorder_prev_states(self):
+        """
+        Compile a callable object of signature
+            f(src_b) -> None
+        As a side effect, calling it updates
+            v_prev_states[b] <- v_prev_states[src_b[b]]
+        where src_b is int32 [batch_size] of batch indices (e.g., surviving
+        hypotheses in beam search), gathered on device without a host copy
+        """
+        p_src_b = tt.ivector(name = 'port_i_src')
+        return th.function(inputs  = [p_src_b],
+                           outputs = [],
+                           updates = self.connect_reorder_graph(p_src_b))
+
+    def connect_reorder_graph(self, p_src_b):
+        """
+        Returns prev_state updates of compile_f_reorder_prev_states for given
+        index port (public for combining Nets as connect_inference_graph)
+        """
+        assert not self._is_training
+
+        updates = []
+        for k in iterkeys(self._prev_dims):
+            if len(self._slices) == 1:
+                v_prev_state = self._slices[0].v_prev_states[k]
+                updates.append((v_prev_state, v_prev_state[p_src_b]))
+                continue
+            # gather from all slices on Net's device, then slice back
+            # (Slice.apply slices the 1-th dimension, hence transposes)
+            s_full_bk = tt.concatenate([self.transfer(s.v_prev_states[k])
+                                        for s in self._slices], axis = 0)
+            s_new_kb = s_full_bk[self.transfer(p_src_b)].T
+            for s in self._slices:
+                updates.append((s.v_prev_states[k], s.apply(s_new_kb).T))
+
+        return updates
+
     def compile_f_fwd_bwd_propagate(self):
         """
         Compile a callable object of signature
@@ -453,7 +625,7 @@ class Net():
         - Output is a list of np.ndarray (i.e., loss = np.asscalar(output[0]))
         - For validation (obtain loss only), call f_fwd_propagate instead
         """
-        assert self._is_training
+        assert self._is_training and not self._fused_update
         on_unused_input = 'raise' # 'ignore'
         return th.function(inputs  = self._prop_i_ports,
                            outputs = self._prop_o_ports,
@@ -472,11 +644,32 @@ class Net():
           because it uses gradients stored in _v_grads
         - For validation, don't call f_update_v_params
         """
-        assert self._is_training
+        assert self._is_training and not self._fused_update
         return th.function(inputs  = self._update_i_ports,
                            outputs = [],
                            updates = self._optim_param_updates)
 
+    def compile_f_fwd_bwd_update(self):
+        """
+        Compile a callable object of signature
+            f(input_tbi, target_tbi, step_size, lr) -> [loss]
+        As a side effect, calling it updates
+            v_prev_states, v_optim_states, v_params
+        
+        - Same as f_fwd_bwd_propagate followed by f_update_v_params, but in
+          one call and without writing/reading gradients to/from v_grads
+          (requires fused_update = True at construction)
+        - For validation (obtain loss only), call f_fwd_propagate instead
+        """
+        assert self._is_training and self._fused_update
+        on_unused_input = 'raise' # 'ignore'
+        return th.function(inputs  = (self._prop_i_ports
+                                      + self._update_i_ports),
+                           outputs = self._prop_o_ports,
+                           updates = (self._prev_state_updates
+                                      + self._optim_param_updates),
+                           on_unused_input = on_unused_input)
+
     def compile_f_initialize_optimizer(self):
         """
         Compile a callable object of signature
@@ -490,20 +683,38 @@ class Net():
                            outputs = [],
                            updates = self._optim_inits)
 
-    def save_to_workspace(self, name = None):
+    def save_to_workspace(self, name = None, from_snapshot = False):
         """
-        Transfer parameters from GPU to file
+        Transfer parameters from GPU (or from the snapshot of the same name
+        if from_snapshot) to file, replacing it atomically
+        Returns time (sec) the call blocked, which with async_save excludes
+        writing the file (done in background)
         """
         assert self._is_training
         sfx = name if name is not None else ''
+        start = time.time()
 
-        # v_params in all slices are in sync, so we just use 0-th
-        for k, v_param in iteritems(self._slices[0].v_params):
-            self._params[k] = v_param.get_value() # pull from GPU
+        if from_snapshot:
+            params = self._snapshots[name] # not modified but replaced
+        else:
+            # v_params in all slices are in sync, so we just use 0-th
+            for k, v_param in iteritems(self._slices[0].v_params):
+                self._params[k] = v_param.get_value() # pull from GPU
+            params = OrderedDict(self._params) # _params changes on next call
+
+        file = self._save_to + '/params' + sfx + '.npz'
+        if self._writer is not None:
+            self._writer.write(file, params)
+        else:
+            write_params(file, params)
+        return time.time() - start
 
-        # There is also savez_compressed, but parameter data
-        # doesn't offer much opportunities for compression
-        np.savez(self._save_to + '/params' + sfx + '.npz', **self._params)
+    def flush_workspace(self):
+        """
+        Blocks until files queued by save_to_workspace are written
+        """
+        if self._writer is not None:
+            self._writer.flush()
 
     def load_from_workspace(self, name = None):
         """
@@ -511,6 +722,7 @@ class Net():
         """
         assert self._is_training
         sfx = name if name is not None else ''
+        self.flush_workspace()
         
         # ret = NpzFile object
         params = np.load(self._save_to + '/params' + sfx + '.npz')
@@ -518,15 +730,96 @@ class Net():
             for k, v_param in iteritems(s.v_params):
                 v_param.set_value(params[k]) # push to GPU
     
+    def snapshot(self, name = None):
+        """
+        Transfer parameters from GPU to a host memory copy kept under name
+        (replacing previous one of the same name), for transient copies
+        that need not be written to file
+        """
+        assert self._is_training
+        self._snapshots[name] = OrderedDict \
+            ((k, v_param.get_value()) # pull from GPU
+             for k, v_param in iteritems(self._slices[0].v_params))
+
+    def restore(self, name = None):
+        """
+        Transfer parameters from snapshot of given name to GPU
+        """
+        assert self._is_training
+        params = self._snapshots[name]
+        for s in self._slices:
+            for k, v_param in iteritems(s.v_params):
+                v_param.set_value(params[k]) # push to GPU
+
+    def drop_snapshot(self, name = None):
+        assert self._is_training
+        del self._snapshots[name]
+
     def remove_from_workspace(self, name = None):
         """
         Remove temporary file from the workspace
         """
         assert self._is_training
         sfx = name if name is not None else ''
+        self.flush_workspace()
 
         os.remove(self._save_to + '/params' + sfx + '.npz')
     
+    def get_prev_states(self, lanes = None):
+        """
+        Returns prev_states of given batch indices (list or np.ndarray of
+        int) or of all if lanes is None, as one np.ndarray
+            float32 [len(lanes)][state_dim()]
+        with states of all layers concatenated in the 1-th dimension
+        """
+        n = self._options['batch_size']
+        lanes = np.arange(n) if lanes is None else np.asarray(lanes)
+        states_bk = np.zeros((lanes.shape[0], self.state_dim()),
+                             dtype = 'float32')
+        for s in self._slices:
+            where, local = s.localize(lanes, n)
+            if local.shape[0] == 0:
+                continue
+            states_bk[where] = np.concatenate \
+                ([v.get_value()[local] for v in itervalues(s.v_prev_states)],
+                 axis = 1)
+        return states_bk
+
+    def set_prev_states(self, states_bk, lanes = None):
+        """
+        Overwrite prev_states of given batch indices (or of all if lanes is
+        None) with states_bk in the format returned by get_prev_states
+        """
+        n = self._options['batch_size']
+        lanes = np.arange(n) if lanes is None else np.asarray(lanes)
+        assert states_bk.shape == (lanes.shape[0], self.state_dim())
+        for s in self._slices:
+            where, local = s.localize(lanes, n)
+            if local.shape[0] == 0:
+                continue
+            lo = 0
+            for k, v_prev_state in iteritems(s.v_prev_states):
+                hi = lo + self._prev_dims[k]
+                state = v_prev_state.get_value()
+                state[local] = states_bk[where, lo : hi]
+                v_prev_state.set_value(state)
+                lo = hi
+
+    def reset_prev_states(self, lanes = None):
+        """
+        Zero prev_states of given batch indices (list or np.ndarray of int)
+        or of all if lanes is None
+        """
+        n = self._options['batch_size'] if lanes is None else len(lanes)
+        self.set_prev_states(np.zeros((n, self.state_dim()),
+                                      dtype = 'float32'), lanes)
+
+    def state_dim(self):
+        """
+        Returns size of the per-lane state vector of get/set_prev_states
+        """
+        return sum(itervalues(self._prev_dims))
+
     def transfer(self, s_in):
         """
         Return given node transferred to Net's device (same as 0-th Slice)
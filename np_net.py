@@ -0,0 +1,326 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+NumPy-only inference engine for models trained by train.py
+
+- Mirrors the forward graphs of layers.py (FC/OneHot/LSTM/GRU/RHN, incl.
+  peepholes, weight norm, layer norm, and residual gates) without importing
+  Theano, so that startup takes milliseconds instead of a compile
+- Weight norm is folded into the weight matrices once at load time
+  (quantized checkpoints of quantize.py come with it folded already and
+  are loaded if the workspace has no params.npz, keeping their matrices
+  quantized in memory as quantize.QMatrix)
+- Drop-in for an inference Net when used as
+      net = NpNet(options, None, 'workspace_dir')
+      f_fwd_propagate = net.compile_f_fwd_propagate()
+      output_tbi = f_fwd_propagate(input_tbi)[0]
+  where options['batch_size'] must be specified; any number of time steps
+  may be given per call (window == step)
+- check_np_net.py compares outputs and states against Net on a workspace
+"""
+
+from __future__ import absolute_import, division, print_function
+from six import itervalues
+from six.moves import cPickle as pk
+
+import numpy as np
+from sampling import sample
+from quantize import load_quantized
+import os
+
+def sigmoid(x):
+    return 0.5 * (1. + np.tanh(0.5 * x)) # same as 1 / (1 + exp(-x))
+
+def softmax(x_bi):
+    e_bi = np.exp(x_bi - x_bi.max(axis = 1, keepdims = True))
+    return e_bi / e_bi.sum(axis = 1, keepdims = True)
+
+def layer_norm(x_bi, s_i, b_i):
+    y_bi = (x_bi - x_bi.mean(1)[:, None]) / np.sqrt(x_bi.var(1)[:, None]
+                                                    + 1e-5)
+    return s_i[None, :] * y_bi + b_i[None, :]
+
+def dot(x_mj, W_jk):
+    if hasattr(W_jk, 'rdot'): # quantize.QMatrix
+        return W_jk.rdot(x_mj)
+    return np.dot(x_mj, W_jk)
+
+def weight_norm(W_jk, g_k):
+    return (g_k * W_jk / np.linalg.norm(W_jk, axis = 0, keepdims = True)) \
+           .astype('float32')
+
+class NpLayer:
+    def __init__(self, name, params, options):
+        self.name = name
+        self.state_dim = 0
+        self._params = params
+        self._options = options
+
+    def param(self, name):
+        p = self._params[self.name + '_' + name]
+        return p if hasattr(p, 'rdot') else p.astype('float32')
+
+    def has_param(self, name):
+        return self.name + '_' + name in self._params
+
+    def option(self, name):
+        return name in self._options and self._options[name]
+
+    def norms(self, k, ranges):
+        """
+        Returns k layer norm functions over given ln_s/ln_b (start, stop)
+        ranges, or identities if layer norm is off
+        """
+        if not self.option('layer_norm'):
+            return [lambda x_bi: x_bi] * k
+        s, b = self.param('ln_s'), self.param('ln_b')
+        return [(lambda x_bi, s_i = s[lo : hi], b_i = b[lo : hi]:
+                     layer_norm(x_bi, s_i, b_i)) for lo, hi in ranges]
+
+    def res_gate(self, h_tbi, below_tbj):
+        if not self.has_param('rg_k'):
+            return h_tbi
+        g_i = sigmoid(self.param('rg_k'))
+        return g_i * h_tbi + (1. - g_i) * below_tbj
+
+class NpOneHot(NpLayer):
+    def __init__(self, name, params, options, n_out):
+        NpLayer.__init__(self, name, params, options)
+        self._eye = np.eye(n_out, dtype = 'float32')
+
+    def forward(self, below_tbj, state_bk):
+        return self._eye[below_tbj[:, :, 0]], None
+
+class NpFC(NpLayer): # softmax only, as used by Net
+    def __init__(self, name, params, options):
+        NpLayer.__init__(self, name, params, options)
+        self._W = self.param('W')
+        self._b = self.param('b')
+
+    def forward(self, below_tbj, state_bk):
+        T, B = below_tbj.shape[: 2]
+        preact = dot(below_tbj.reshape((T * B, -1)), self._W) + self._b
+        return softmax(preact).reshape((T, B, -1)), None
+
+class NpLSTM(NpLayer):
+    def __init__(self, name, params, options):
+        NpLayer.__init__(self, name, params, options)
+        self._W = self.param('W')
+        self._b = self.param('b')
+        self._U = self.param('U')
+        if self.option('weight_norm') and self.has_param('wn_Wg'):
+            self._W = weight_norm(self._W, self.param('wn_Wg'))
+            self._U = weight_norm(self._U, self.param('wn_Ug'))
+        self.n_out = n = self._U.shape[0]
+        self._p = self.param('p') if options['lstm_peephole'] else \
+                  np.zeros(3 * n, dtype = 'float32')
+        self._n = self.norms(3, [(0, 4 * n), (4 * n, 8 * n), (8 * n, 9 * n)])
+        self.state_dim = 2 * n # h, c
+
+    def forward(self, below_tbj, state_bk):
+        n, p, nm = self.n_out, self._p, self._n
+        x_tb4i = dot(below_tbj, self._W) + self._b
+        h_bi, c_bi = state_bk[:, : n], state_bk[:, n :]
+
+        h_list = []
+        for x_b4i in x_tb4i:
+            pre = nm[0](x_b4i) + nm[1](dot(h_bi, self._U))
+            i_bi = sigmoid(pre[:, 0 * n : 1 * n] + p[0 * n : 1 * n] * c_bi)
+            f_bi = sigmoid(pre[:, 1 * n : 2 * n] + p[1 * n : 2 * n] * c_bi)
+            c_bi = i_bi * np.tanh(pre[:, 2 * n : 3 * n]) + f_bi * c_bi
+            o_bi = sigmoid(pre[:, 3 * n : 4 * n] + p[2 * n : 3 * n] * c_bi)
+            h_bi = o_bi * np.tanh(nm[2](c_bi))
+            h_list.append(h_bi)
+
+        return (self.res_gate(np.stack(h_list), below_tbj),
+                np.concatenate([h_bi, c_bi], axis = 1))
+
+class NpGRU(NpLayer):
+    def __init__(self, name, params, options):
+        NpLayer.__init__(self, name, params, options)
+        self._W = self.param('W')
+        self._b = self.param('b')
+        self._U = self.param('U')
+        if self.option('weight_norm') and self.has_param('wn_Wg'):
+            self._W = weight_norm(self._W, self.param('wn_Wg'))
+            self._U = weight_norm(self._U, self.param('wn_Ug'))
+        self.n_out = n = self._U.shape[0]
+        self._n = self.norms(4, [(0, 2 * n), (2 * n, 4 * n),
+                                 (4 * n, 5 * n), (5 * n, 6 * n)])
+        self.state_dim = n # h
+
+    def forward(self, below_tbj, state_bk):
+        n, nm = self.n_out, self._n
+        U_2i, U_1i = self._U[:, : 2 * n], self._U[:, 2 * n :]
+        x_tb3i = dot(below_tbj, self._W) + self._b
+        h_bi = state_bk
+
+        h_list = []
+        for x_b3i in x_tb3i:
+            pre = nm[0](x_b3i[:, : 2 * n]) + nm[1](dot(h_bi, U_2i))
+            r_bi = sigmoid(pre[:, : n])
+            u_bi = sigmoid(pre[:, n :])
+            c_bi = np.tanh(nm[2](x_b3i[:, 2 * n :])
+                           + r_bi * nm[3](dot(h_bi, U_1i)))
+            h_bi = (1. - u_bi) * h_bi + u_bi * c_bi
+            h_list.append(h_bi)
+
+        return self.res_gate(np.stack(h_list), below_tbj), h_bi
+
+class NpRHN(NpLayer):
+    def __init__(self, name, params, options):
+        NpLayer.__init__(self, name, params, options)
+        self._W = self.param('W')
+        self._R = self.param('R')
+        self._b = self.param('b')
+        self.n_out = self._R.shape[0]
+        self.n_layers = options['rhn_n_layers']
+        self.state_dim = self.n_out # y
+
+    def forward(self, below_tbj, state_bk):
+        n = self.n_out
+        Wx_tb2i = dot(below_tbj, self._W)
+        s_bi = state_bk
+
+        y_list = []
+        for Wx_b2i in Wx_tb2i:
+            for l in range(self.n_layers):
+                H, T = 2 * l, 2 * l + 1
+                RHs_bi = dot(s_bi, self._R[:, H * n : (H + 1) * n])
+                RTs_bi = dot(s_bi, self._R[:, T * n : (T + 1) * n])
+                if l == 0:
+                    RHs_bi += Wx_b2i[:, : n]
+                    RTs_bi += Wx_b2i[:, n :]
+                h_bi = np.tanh(RHs_bi + self._b[H * n : (H + 1) * n])
+                t_bi = sigmoid(RTs_bi + self._b[T * n : (T + 1) * n])
+                s_bi = h_bi * t_bi + s_bi * (1. - t_bi)
+            y_list.append(s_bi)
+
+        return np.stack(y_list), s_bi
+
+class NpNet:
+    def __init__(self, options, save_to = None, load_from = None,
+                       c_names = None, params = None):
+        """
+        Same arguments as an inference Net (save_to and c_names are unused),
+        with options['step_size'] ignored
+            [params]    dict-like { str : np.ndarray } (instead of loading
+                                                        load_from/params.npz)
+        """
+        assert save_to is None and load_from is not None
+        assert 'batch_size' in options
+
+        with open(load_from + '/options.pkl', 'rb') as f:
+            self._options = pk.load(f)
+        self._options['batch_size'] = options['batch_size']
+
+        if params is None and os.path.isfile(load_from + '/params.npz'):
+            params = np.load(load_from + '/params.npz') # NpzFile object
+        elif params is None:
+            params = load_quantized(load_from)
+        params = dict((k, params[k]) for k in params.keys())
+        self._params = params
+
+        assert self._options['loss_type'] == 'crossentropy'
+        unit = self._options['unit_type'].upper()
+        layer_type = { 'LSTM' : NpLSTM, 'GRU' : NpGRU, 'RHN' : NpRHN }[unit]
+
+        self._layers = [NpOneHot('OneHot', params, self._options,
+                                 self._options['input_dim'])]
+        for i in range(1, 1 + self._options['net_depth']):
+            self._layers.append(layer_type(unit + '_' + str(i), params,
+                                           self._options))
+        self._layers.append(NpFC('Softmax', params, self._options))
+
+        self._prev_states = [np.zeros((options['batch_size'], l.state_dim),
+                                      dtype = 'float32') \
+                             for l in self._layers]
+
+    def propagate(self, input_tbi):
+        """
+        Returns output_tbi for input_tbi (int [n_steps][batch_size][1]),
+        updating prev_states to the last time index
+        """
+        s_tbj = input_tbi
+        for k, layer in enumerate(self._layers):
+            s_tbj, state = layer.forward(s_tbj, self._prev_states[k])
+            if state is not None:
+                self._prev_states[k] = state.astype('float32')
+        return s_tbj.astype('float32')
+
+    def compile_f_fwd_propagate(self, step_size = None):
+        """
+        Returns callable of same signature as inference Net's
+            f(input_tbi) -> [output_tbi]
+        (which takes any number of time steps regardless of step_size)
+        """
+        return lambda input_tbi: [self.propagate(input_tbi)]
+
+    def compile_f_sample(self, n_chars, temperature = 1., seed = None):
+        """
+        Returns callable of same signature as inference Net's
+            f(pred_tbi) -> [sample_tb, pred_tbi]
+        (a host-side loop here, but still one call for n_chars characters)
+        """
+        rng = np.random.RandomState(seed)
+        def f(pred_tbi):
+            samples = []
+            for _ in range(n_chars):
+                i_b = sample(pred_tbi[0], temperature, rng = rng)
+                samples.append(i_b)
+                pred_tbi = self.propagate(i_b.reshape((1, -1, 1)))
+            return [np.stack(samples), pred_tbi]
+        return f
+
+    def compile_f_reorder_prev_states(self):
+        """
+        Returns callable of same signature as inference Net's
+            f(src_b) -> None
+        """
+        def f(src_b):
+            for k, state in enumerate(self._prev_states):
+                self._prev_states[k] = state[np.asarray(src_b)]
+        return f
+
+    def get_prev_states(self, lanes = None):
+        """
+        Same as Net.get_prev_states (layers in the same order)
+        """
+        lanes = slice(None) if lanes is None else np.asarray(lanes)
+        return np.concatenate([state[lanes] for state in self._prev_states],
+                              axis = 1)
+
+    def set_prev_states(self, states_bk, lanes = None):
+        lanes = slice(None) if lanes is None else np.asarray(lanes)
+        lo = 0
+        for state in self._prev_states:
+            hi = lo + state.shape[1]
+            state[lanes] = states_bk[:, lo : hi]
+            lo = hi
+        assert states_bk.shape[1] == lo
+
+    def reset_prev_states(self, lanes = None):
+        lanes = slice(None) if lanes is None else np.asarray(lanes)
+        for state in self._prev_states:
+            state[lanes] = 0.
+
+    def state_dim(self):
+        return sum(state.shape[1] for state in self._prev_states)
+
+    def dimensions(self):
+        return self._options['input_dim'], self._options['target_dim']
+
+    def n_weights(self):
+        return sum(p.size for p in itervalues(self._params))
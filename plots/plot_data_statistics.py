@@ -16,13 +16,18 @@ from __future__ import absolute_import, division, print_function
 
 import numpy as np
 import matplotlib
-from collections import Counter
+import os
+import sys
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+from corpus_stats import get_stats, ngram_entropies
 
 def main():
 
-    train = np.fromfile('../data/train', dtype = '<i1') % 32
-    valid = np.fromfile('../data/dev'  , dtype = '<i1') % 32
-    test  = np.fromfile('../data/test' , dtype = '<i1') % 32
+    # [unigram, bigram, trigram] counts (cached next to data)
+    train = get_stats(os.path.join(ROOT, 'data', 'train'))
+    valid = get_stats(os.path.join(ROOT, 'data', 'dev'  ))
+    test  = get_stats(os.path.join(ROOT, 'data', 'test' ))
 
     matplotlib.use('TkAgg')
     import matplotlib.pyplot as plt
@@ -30,18 +35,16 @@ def main():
     fig = plt.figure(figsize=[4.5 * 3, 3.5])
     plt.get_current_fig_manager().window.wm_geometry("+0+0")
 
-    for i, data, name in zip(range(3), [train, valid, test],
-                                       ['Training', 'Validation', 'Test']):
-        freq_dict = Counter(data)
-        
+    for i, counts, name in zip(range(3), [train, valid, test],
+                                         ['Training', 'Validation', 'Test']):
         x = range(27)
-        
-        freq = [freq_dict[k] for k in x]
+
+        freq = counts[0]
         tot = sum(freq)
         
         y = [float(f) / tot for f in freq]
 
-        entropy = sum([-p * np.log2(p) for p in y])
+        entropy = ngram_entropies(counts)
 
         plt.subplot(1, 3, i + 1)
         plt.bar(x, y)
@@ -52,7 +55,8 @@ def main():
         plt.xticks(x, [chr(i + 96) if i > 0 else '_' for i in x])
         plt.title(name + ' set')
 
-        print(name.ljust(len('Validation')) + ' set: %.3f bpc' % entropy)
+        print(name.ljust(len('Validation')) + ' set: %.3f bpc' % entropy[0]
+              + ' (bigram %.3f, trigram %.3f)' % tuple(entropy[1 :]))
 
     plt.tight_layout()
     fig.savefig('char_probability.eps', format='eps')
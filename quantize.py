@@ -0,0 +1,229 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Export a trained workspace's params.npz as a quantized checkpoint
+(QUANTIZED_NAME) for NumPy inference (np_net.py), and report the resulting
+accuracy loss, size, and speed
+
+Use as:
+    python quantize.py --workspace=some_dir [--format=int8] \
+                       [--dev=data/dev] [--batch_size=128] [--max_chars=N]
+
+- Weight norm gains are folded into the weight matrices first
+- Weight matrices (2-D params) are stored as
+      int8      per-column symmetric int8 with float32 scales
+                (W_jk ~ q_jk * scale_k, scale_k = max_j |W_jk| / 127)
+      float16   float16 (no scales)
+  while vectors (biases, peepholes, layer norm, gates) stay float32
+- NpNet loads QUANTIZED_NAME when the workspace has no params.npz, so the
+  quantized file can be shipped alone (with options.pkl); weight matrices
+  stay quantized in memory (QMatrix) and are upcast to float32 one block
+  of columns at a time in each product, so resident size shrinks as much
+  as checkpoint size, at the cost of per-step speed (NumPy has no int8 or
+  float16 matrix products faster than float32 BLAS)
+- With --dev, bpc of the original and quantized weights are compared on
+  the dev file along with chars/sec of NpNet for each
+"""
+
+from __future__ import absolute_import, division, print_function
+from six import iteritems
+
+import numpy as np
+import argparse
+import os
+import time
+from collections import OrderedDict
+
+QUANTIZED_NAME = 'params_q.npz'
+FORMATS = ['int8', 'float16']
+SCALE_SFX = '__scale'
+BLOCK_BYTES = 1 << 20 # size of float32 columns upcast at once by QMatrix
+
+class QMatrix:
+    def __init__(self, q_jk, scale_k = None):
+        """
+        Quantized weight matrix W_jk ~ q_jk * scale_k used in place of a
+        float32 matrix by NpNet
+            q_jk        np.ndarray  int8 or float16
+            [scale_k]   np.ndarray  float32 (None for float16)
+        """
+        self._q     = q_jk
+        self._scale = scale_k
+        self._block = max(1, BLOCK_BYTES // (4 * q_jk.shape[0]))
+
+        self.shape  = q_jk.shape
+        self.size   = q_jk.size
+        self.nbytes = q_jk.nbytes + (scale_k.nbytes if scale_k is not None
+                                     else 0)
+
+    def __getitem__(self, idx):
+        """
+        Column slice as in W_jk[:, lo : hi], sharing memory
+        """
+        rows, cols = idx
+        assert rows == slice(None)
+        return QMatrix(self._q[:, cols],
+                       self._scale[cols] if self._scale is not None else None)
+
+    def rdot(self, x_mj):
+        """
+        Returns float32 np.dot(x_mj, W_jk) for x_mj of any number of leading
+        dimensions
+        """
+        J, K = self.shape
+        x_mj2 = x_mj.reshape((-1, J)).astype('float32')
+        y_mk = np.empty((x_mj2.shape[0], K), dtype = 'float32')
+        for lo in range(0, K, self._block):
+            hi = min(lo + self._block, K)
+            y_mk[:, lo : hi] = np.dot(x_mj2, self._q[:, lo : hi]
+                                             .astype('float32'))
+            if self._scale is not None:
+                y_mk[:, lo : hi] *= self._scale[lo : hi]
+        return y_mk.reshape(x_mj.shape[: -1] + (K,))
+
+def fold_weight_norm(params):
+    """
+    Returns params (dict { str : np.ndarray }) with weight norm applied to
+    its matrices and the gains removed
+    """
+    from np_net import weight_norm # avoid circular import
+
+    ret = OrderedDict((k, v) for k, v in iteritems(params))
+    for k, v in iteritems(params):
+        for g, m in [('_wn_Wg', '_W'), ('_wn_Ug', '_U')]:
+            if k.endswith(g):
+                name = k[: -len(g)] + m
+                ret[name] = weight_norm(params[name].astype('float32'), v)
+                del ret[k]
+    return ret
+
+def quantize_params(params, format):
+    """
+    Returns dict { str : np.ndarray } to be saved as QUANTIZED_NAME
+    """
+    assert format in FORMATS
+    ret = OrderedDict()
+    for k, v in iteritems(fold_weight_norm(params)):
+        v = v.astype('float32')
+        if v.ndim != 2:
+            ret[k] = v
+        elif format == 'float16':
+            ret[k] = v.astype('float16')
+        else:
+            scale_k = np.abs(v).max(axis = 0) / 127.
+            scale_k[scale_k == 0.] = 1.
+            ret[k] = np.round(v / scale_k).astype('int8')
+            ret[k + SCALE_SFX] = scale_k.astype('float32')
+    return ret
+
+def resident_params(qparams):
+    """
+    Returns dict { str : QMatrix or float32 np.ndarray } for NpNet from
+    dict-like of quantize_params (weight norm folded, hence without gains)
+    """
+    ret = OrderedDict()
+    for k in qparams.keys():
+        if k.endswith(SCALE_SFX):
+            continue
+        v = qparams[k]
+        if v.dtype == np.int8:
+            ret[k] = QMatrix(v, qparams[k + SCALE_SFX])
+        elif v.ndim == 2:
+            ret[k] = QMatrix(v)
+        else:
+            ret[k] = v.astype('float32')
+    return ret
+
+def load_quantized(workspace):
+    with np.load(workspace + '/' + QUANTIZED_NAME) as f:
+        return resident_params(f)
+
+def evaluate(net, text_file, batch_size, max_chars):
+    """
+    Returns (bpc, chars/sec) of NpNet net over text_file (see data.EvalIter)
+    """
+    from data import EvalIter
+
+    eval_iter = EvalIter(text_file, 256, batch_size)
+    f_fwd_propagate = net.compile_f_fwd_propagate()
+
+    loss, n_chars = 0., 0
+    start = time.time()
+    for input_tbi, target_tbi, step_size, reset in eval_iter:
+        if reset:
+            net.reset_prev_states()
+        p_tbi = f_fwd_propagate(input_tbi)[0][-step_size :]
+        t_tb = target_tbi[-step_size :, :, 0]
+        T, B = t_tb.shape
+        p_tb = p_tbi[np.arange(T)[:, None], np.arange(B)[None, :], t_tb]
+        loss -= np.sum(np.log2(p_tb))
+        n_chars += t_tb.size
+        if max_chars is not None and n_chars >= max_chars:
+            break
+    return loss / n_chars, n_chars / (time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workspace', type = str, required = True)
+    parser.add_argument('--format', type = str, default = 'int8',
+                        choices = FORMATS)
+    parser.add_argument('--dev', type = str)
+    parser.add_argument('--batch_size', type = int, default = 128)
+    parser.add_argument('--max_chars', type = int)
+    args = parser.parse_args()
+
+    ws = args.workspace
+    with np.load(ws + '/params.npz') as f:
+        params = OrderedDict((k, f[k]) for k in f.keys())
+
+    qparams = quantize_params(params, args.format)
+    np.savez(ws + '/' + QUANTIZED_NAME, **qparams)
+    rparams = resident_params(qparams)
+
+    # resident: what NpNet keeps for its products (float32 with weight norm
+    # folded, or QMatrix)
+    size = lambda d: sum(v.nbytes for v in d.values())
+    print('Saved ' + ws + '/' + QUANTIZED_NAME + ' (' + args.format + ')')
+    for name, before, after in [('checkpoint', params, qparams),
+                                ('resident', fold_weight_norm(params),
+                                             rparams)]:
+        print('    ' + name.ljust(10) + ' : %.2f MB -> %.2f MB (%.2fx)'
+              % (size(before) / 2. ** 20, size(after) / 2. ** 20,
+                 size(before) / size(after)))
+    print('    file       : %.2f MB -> %.2f MB'
+          % (os.path.getsize(ws + '/params.npz') / 2. ** 20,
+             os.path.getsize(ws + '/' + QUANTIZED_NAME) / 2. ** 20))
+
+    if args.dev is None:
+        return
+
+    from np_net import NpNet
+
+    options = OrderedDict()
+    options['step_size']  = 256
+    options['batch_size'] = args.batch_size
+
+    results = []
+    for name, p in [('float32', params),
+                    (args.format, rparams)]:
+        net = NpNet(options, None, ws, params = p)
+        bpc, speed = evaluate(net, args.dev, args.batch_size, args.max_chars)
+        results.append(bpc)
+        print('    ' + name.ljust(10) + ' : %.4f bpc, %.0f chars/sec'
+              % (bpc, speed))
+    print('    delta      : %+.4f bpc' % (results[1] - results[0]))
+
+if __name__ == '__main__':
+    main()
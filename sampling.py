@@ -0,0 +1,87 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Vectorized sampling of class indices from batches of distributions
+
+- All rows of p_bi [batch][class] are sampled at once by inverse CDF in
+  float32, which does not require rows to be exactly normalized (so neither
+  a float64 conversion nor renormalization is needed)
+- Temperature, top-k, and nucleus (top-p) filtering are applied before
+  sampling, in this order
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+def apply_temperature(p_bi, temperature):
+    """
+    Returns unnormalized p_bi ** (1 / temperature)
+    """
+    logit_bi = np.log(np.maximum(p_bi, np.float32(1e-30))) \
+               / np.float32(temperature)
+    return np.exp(logit_bi - logit_bi.max(axis = 1, keepdims = True))
+
+def filter_top_k(p_bi, k):
+    """
+    Zero all but the k largest probabilities of each row (ties are kept)
+    """
+    if k >= p_bi.shape[1]:
+        return p_bi
+    kth_b1 = -np.partition(-p_bi, k - 1, axis = 1)[:, k - 1 : k]
+    return np.where(p_bi >= kth_b1, p_bi, np.float32(0.))
+
+def filter_top_p(p_bi, top_p):
+    """
+    Zero all but the smallest set of largest probabilities of each row whose
+    sum reaches top_p of the row sum (ties are kept)
+    """
+    s_bi = -np.sort(-p_bi, axis = 1) # descending
+    c_bi = np.cumsum(s_bi, axis = 1)
+    # number of kept classes = 1 + number of prefixes summing below top_p
+    n_b = 1 + np.sum(c_bi[:, : -1] < top_p * c_bi[:, -1 :], axis = 1)
+    min_b1 = s_bi[np.arange(p_bi.shape[0]), n_b - 1][:, None]
+    return np.where(p_bi >= min_b1, p_bi, np.float32(0.))
+
+def sample(p_bi, temperature = 1., top_k = None, top_p = None,
+           rng = np.random):
+    """
+    Returns int32 [batch] of class indices drawn from rows of p_bi
+        p_bi            np.ndarray  [batch][class] (probabilities)
+        [temperature]   float       > 0. (< 1. sharpens, > 1. flattens)
+        [top_k]         int         keep k most probable classes
+        [top_p]         float       keep most probable classes up to top_p
+                                    of probability mass (nucleus sampling)
+        [rng]           np.random.RandomState or np.random
+    """
+    p_bi = np.asarray(p_bi, dtype = 'float32')
+    if temperature != 1.:
+        assert temperature > 0.
+        p_bi = apply_temperature(p_bi, temperature)
+    if top_k is not None:
+        assert top_k > 0
+        p_bi = filter_top_k(p_bi, top_k)
+    if top_p is not None:
+        assert 0. < top_p <= 1.
+        p_bi = filter_top_p(p_bi, top_p)
+
+    # smallest index i with cdf[i] > u, where u ~ Uniform [0, row sum),
+    # in float64 and clamped to the last class with nonzero probability so
+    # that rounding can never pick a filtered class
+    c_bi = np.cumsum(p_bi, axis = 1, dtype = 'float64')
+    u_b1 = rng.random_sample((p_bi.shape[0], 1)) * c_bi[:, -1 :]
+    last_b = p_bi.shape[1] - 1 - np.argmax(p_bi[:, ::-1] > 0., axis = 1)
+    return np.minimum(np.sum(c_bi <= u_b1, axis = 1),
+                      last_b).astype('int32')
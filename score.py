@@ -0,0 +1,173 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Script for scoring text with models trained by train.py, streaming a file
+(or stdin) through an inference net and printing bits per character (bpc)
+Models are set in gen_text.cfg unless given with --model (several models
+make an ensemble if --mix is given; see gen_text.py)
+
+Use as:
+    python score.py some_text_file
+    cat some_text_file | python score.py
+    python score.py --engine=numpy --window=1024 some_text_file
+    python score.py --model=dir_1 --model=dir_2 --mix=avg some_text_file
+    python score.py --dump=logp.txt --chunk_chars=100000 some_text_file
+
+- Characters other than space and letters are skipped (and counted);
+  uppercase letters are scored as lowercase
+- Text is read in blocks and fed to a single lane in windows of --window
+  characters per call (one call per character only for the last < window
+  characters), so memory use does not depend on input size
+- Every character but the first is scored given all preceding ones
+- bpc of each --chunk_chars scored characters is printed as it goes, with
+  the running total and chars/sec; --dump writes one line per scored
+  character as  character<TAB>log2 probability
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import argparse
+import sys
+import time
+from collections import OrderedDict
+from gen_text import load_nets, read_cfg, check_models
+from ensemble import MIX_MODES
+
+def to_indices(block):
+    """
+    Returns tuple (int32 class indices of space/letters in block (bytes),
+                   number of other characters skipped)
+    """
+    raw = np.frombuffer(block, dtype = 'uint8')
+    lower = raw | 0x20
+    keep = (raw == 32) | ((lower >= 97) & (lower <= 122))
+    return (raw[keep] % 32).astype('int32'), raw.shape[0] - np.sum(keep)
+
+class Scorer:
+    def __init__(self, net, window, dump = None):
+        """
+        Accumulates log2 probabilities of characters fed in any number of
+        pieces, as if fed at once
+            net     Net, NpNet, or Ensemble with batch_size 1, step_size 1
+            window  int         time steps per call while streaming
+            [dump]  file object for per-character log2 probabilities
+        """
+        self._f_window = net.compile_f_fwd_propagate(step_size = window)
+        self._f_step   = net.compile_f_fwd_propagate()
+        self._window   = window
+        self._dump     = dump
+        self._buf      = np.zeros(0, dtype = 'int32') # not yet fed
+
+        self.loss    = 0. # sum of -log2 p
+        self.n_chars = 0  # characters scored
+
+    def _score(self, f, input_t, target_t):
+        p_ti = f(input_t.reshape((-1, 1, 1)))[0][:, 0]
+        logp_t = np.log2(p_ti[np.arange(target_t.shape[0]), target_t])
+        self.loss -= np.sum(logp_t)
+        self.n_chars += target_t.shape[0]
+        if self._dump is not None:
+            self._dump.write(''.join((chr(i + 96) if i > 0 else ' ')
+                                     + '\t%.4f\n' % l
+                                     for i, l in zip(target_t, logp_t)))
+
+    def feed(self, i_t):
+        """
+        Scores full windows available after appending i_t
+        """
+        w = self._window
+        buf = np.concatenate([self._buf, i_t])
+        n = (buf.shape[0] - 1) // w # windows with their targets available
+        for k in range(n):
+            self._score(self._f_window, buf[k * w : (k + 1) * w],
+                                        buf[k * w + 1 : (k + 1) * w + 1])
+        self._buf = buf[n * w :]
+
+    def finish(self):
+        """
+        Scores the remaining characters one by one
+        """
+        for k in range(self._buf.shape[0] - 1):
+            self._score(self._f_step, self._buf[k : k + 1],
+                                      self._buf[k + 1 : k + 2])
+        self._buf = self._buf[-1 :]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', type = str, nargs = '?', default = '-')
+    parser.add_argument('--model', type = str, action = 'append')
+    parser.add_argument('--engine', type = str, default = 'theano',
+                        choices = ['theano', 'numpy'])
+    parser.add_argument('--mix', type = str, choices = MIX_MODES)
+    parser.add_argument('--window', type = int, default = 256)
+    parser.add_argument('--chunk_chars', type = int, default = 1000000)
+    parser.add_argument('--block_size', type = int, default = 1 << 20)
+    parser.add_argument('--dump', type = str)
+    args = parser.parse_args()
+
+    models = args.model if args.model is not None else read_cfg()[0]
+    check_models(parser, models, args.mix)
+
+    options = OrderedDict()
+    options['step_size']  = 1
+    options['batch_size'] = 1
+
+    net = load_nets(args.engine, options, models, args.mix)
+
+    dump = open(args.dump, 'w') if args.dump is not None else None
+    scorer = Scorer(net, args.window, dump)
+
+    src = getattr(sys.stdin, 'buffer', sys.stdin) if args.file == '-' else \
+          open(args.file, 'rb')
+
+    n_skipped = 0
+    chunk_loss, chunk_chars = 0., 0
+    start = time.time()
+
+    def report(name):
+        print(name.ljust(8) + '%12d chars : %.4f bpc (total %.4f bpc), '
+              % (scorer.n_chars, chunk_loss / max(chunk_chars, 1),
+                 scorer.loss / max(scorer.n_chars, 1))
+              + '%.0f chars/sec' % (scorer.n_chars / (time.time() - start)))
+        sys.stdout.flush()
+
+    while True:
+        block = src.read(args.block_size)
+        if len(block) == 0:
+            break
+        i_t, skipped = to_indices(block)
+        n_skipped += skipped
+
+        loss, n_chars = scorer.loss, scorer.n_chars
+        scorer.feed(i_t)
+        chunk_loss  += scorer.loss - loss
+        chunk_chars += scorer.n_chars - n_chars
+        if chunk_chars >= args.chunk_chars:
+            report('chunk')
+            chunk_loss, chunk_chars = 0., 0
+    scorer.finish()
+
+    if args.file != '-':
+        src.close()
+    if dump is not None:
+        dump.close()
+
+    chunk_loss, chunk_chars = scorer.loss, scorer.n_chars
+    report('total')
+    print('(%d characters other than space and letters skipped)' % n_skipped)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#   Copyright 2017 Hosang Yoon
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Per-session RNN states for an inference Net (or NpNet), so that a
+conversation continues from where its last turn stopped instead of
+re-priming with the whole history
+
+- States are kept in host memory as vectors in the format of
+  Net.get_prev_states, with at most capacity sessions in least recently
+  used order; evicted sessions are spilled to spill_dir (if given) and
+  loaded back on their next use, or dropped otherwise
+- Use as
+      store = SessionStore(net, capacity, spill_dir)
+      contexts = store.load_lanes(session_ids, lanes) # before the turn
+      (feed contexts[b] + new text to lanes[b], generate)
+      store.save_lanes(session_ids, lanes, unfed) # after the turn
+  where unknown sessions start from zero states
+- Not thread-safe; call from the thread that steps the Net
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import hashlib
+import os
+from collections import OrderedDict
+
+class SessionStore:
+    def __init__(self, net, capacity, spill_dir = None):
+        """
+            net         Net or NpNet    inference net whose lanes are used
+            capacity    int             max number of sessions in memory
+            [spill_dir] str             directory for evicted sessions
+                        NoneType        drop evicted sessions
+        """
+        assert capacity > 0
+        self._net       = net
+        self._capacity  = capacity
+        self._spill_dir = spill_dir
+        self._cache     = OrderedDict() # { id : (state_k, context) }, LRU 1st
+
+        if spill_dir is not None and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+        # counters
+        self.hits      = 0 # found in memory
+        self.disk_hits = 0 # found in spill_dir
+        self.misses    = 0
+        self.evictions = 0
+        self.spills    = 0 # evictions written to spill_dir
+
+    def _spill_file(self, session_id):
+        return os.path.join(self._spill_dir, hashlib.md5(
+                   session_id.encode('utf-8')).hexdigest() + '.npz')
+
+    def _put(self, session_id, item):
+        self._cache.pop(session_id, None)
+        self._cache[session_id] = item # most recently used
+        while len(self._cache) > self._capacity:
+            k, (state_k, context) = self._cache.popitem(last = False)
+            self.evictions += 1
+            if self._spill_dir is not None:
+                np.savez(self._spill_file(k), state = state_k,
+                         context = np.array(context, dtype = 'int32'))
+                self.spills += 1
+
+    def get(self, session_id):
+        """
+        Returns tuple (state_k, context) of given session or None if unknown,
+        where context is a list of class indices to be fed before new input
+        """
+        if session_id in self._cache:
+            self.hits += 1
+            item = self._cache[session_id]
+            self._put(session_id, item) # mark as most recently used
+            return item
+
+        if self._spill_dir is not None:
+            file = self._spill_file(session_id)
+            if os.path.isfile(file):
+                self.disk_hits += 1
+                with np.load(file) as f:
+                    item = (f['state'], list(f['context']))
+                os.remove(file)
+                self._put(session_id, item)
+                return item
+
+        self.misses += 1
+        return None
+
+    def put(self, session_id, state_k, context = []):
+        self._put(session_id, (state_k, list(context)))
+
+    def remove(self, session_id):
+        self._cache.pop(session_id, None)
+        if self._spill_dir is not None \
+                and os.path.isfile(self._spill_file(session_id)):
+            os.remove(self._spill_file(session_id))
+
+    def load_lanes(self, session_ids, lanes):
+        """
+        Sets states of given lanes to those of given sessions (zeros for
+        unknown ones) in one call and returns list of contexts (None for
+        unknown sessions)
+        """
+        states_bk = np.zeros((len(lanes), self._net.state_dim()),
+                             dtype = 'float32')
+        contexts = []
+        for b, session_id in enumerate(session_ids):
+            item = self.get(session_id)
+            if item is not None:
+                states_bk[b] = item[0]
+            contexts.append(item[1] if item is not None else None)
+        self._net.set_prev_states(states_bk, lanes)
+        return contexts
+
+    def save_lanes(self, session_ids, lanes, contexts = None):
+        """
+        Stores states of given lanes to given sessions in one call
+            [contexts]  list of (list of class indices not yet fed; e.g.,
+                                 the last sampled character) per session
+        """
+        states_bk = self._net.get_prev_states(lanes)
+        for b, session_id in enumerate(session_ids):
+            self.put(session_id, states_bk[b],
+                     contexts[b] if contexts is not None else [])
+
+    def stats(self):
+        n_lookups = self.hits + self.disk_hits + self.misses
+        return { 'sessions'  : len(self._cache),
+                 'capacity'  : self._capacity,
+                 'hits'      : self.hits,
+                 'disk_hits' : self.disk_hits,
+                 'misses'    : self.misses,
+                 'hit_rate'  : (self.hits + self.disk_hits)
+                               / max(n_lookups, 1),
+                 'evictions' : self.evictions,
+                 'spills'    : self.spills }
@@ -25,13 +25,31 @@ Use as (for example):
     THEANO_FLAGS=$FLAGS python -u train.py --data_dir=$DATA_DIR \
         --save_to=$MODEL_DIR/workspace_$NAME \
         [--load_from=$MODEL_DIR/workspace_$LOADNAME] [--seed=some_number] \
-        | tee -a $MODEL_DIR/$NAME".log"
+        [--mmap] [--prefetch=queue_size] [--span_size=some_number] \
+        [--fused_update] | tee -a $MODEL_DIR/$NAME".log"
 
 - Device "cuda$" means $-th GPU
 - Flag gpuarray.preallocate reserves given ratio of GPU mem (reduce if needed)
 - Flag base_compiledir directs intermediate files to pwd/theano to avoid
   lock conflicts between multiple training instances (by default ~/.theano)
 - $NAME == $LOADNAME is permitted
+- Flag --mmap maps text files lazily instead of reading them into RAM
+  (recommended for large corpora or multiple training instances)
+- Flag --span_size makes training sequences read shuffled disjoint spans of
+  the given length instead of starting at random positions, so that every
+  frame is seen once per pass (use a multiple of step_size; see data.py)
+- If compiled corpora exist (see compile_corpus.py), they are opened
+  instantly in place of $DATA_DIR/{train,dev,test}
+- When sweeping many configurations on one machine, run corpus_server.py
+  on $DATA_DIR/{train,dev,test} first to share a single in-memory copy
+- Each of $DATA_DIR/{train,dev,test} may also be a directory of shards with
+  an index (see compile_corpus.py --index), used as one concatenated file
+- Flag --prefetch assembles minibatches in a background thread, keeping up
+  to queue_size of them ready (0 to disable)
+- Best parameters are saved as params.npz in the workspace, written in a
+  background thread and replaced atomically (see checkpoint.py)
+- Flag --fused_update computes gradients and updates parameters in a single
+  compiled call per minibatch, without gradient buffers (see Net)
 """
 
 from __future__ import absolute_import, division, print_function
@@ -40,7 +58,8 @@ from six import iterkeys, itervalues, iteritems
 from collections import OrderedDict
 import argparse
 from net import Net
-from data import DataIter
+from data import DataIter, PrefetchIter, EvalIter
+from corpus_stats import get_stats, ngram_entropies
 import time
 import numpy as np
 import theano as th
@@ -95,6 +114,10 @@ def main():
     parser.add_argument('--save_to'  , type = str, required = True)
     parser.add_argument('--load_from', type = str)
     parser.add_argument('--seed'     , type = int)
+    parser.add_argument('--mmap'     , action = 'store_true') # see corpus.py
+    parser.add_argument('--prefetch' , type = int, default = 0)
+    parser.add_argument('--span_size', type = int)
+    parser.add_argument('--fused_update', action = 'store_true')
     args = parser.parse_args()
 
     # make sure directory args.save_to exists
@@ -114,18 +137,28 @@ def main():
     np.random.seed(seed)
 
     # NOTE: window_size must be the same as that given to Net
-    train_data = DataIter(text_file   = args.data_dir + '/train',
+    def make_data_iter(text_file):
+        kwargs = dict(text_file   = text_file,
+                      window_size = options['window_size'],
+                      step_size   = options['step_size'],
+                      batch_size  = options['batch_size'],
+                      mmap        = args.mmap,
+                      span_size   = args.span_size)
+        if args.prefetch > 0:
+            return PrefetchIter(queue_size = args.prefetch, **kwargs)
+        return DataIter(**kwargs)
+
+    train_data = make_data_iter(args.data_dir + '/train')
+
+    # dev/test are evaluated exactly once over the whole file (see data.py)
+    dev_data   = EvalIter(text_file   = args.data_dir + '/dev',
                           window_size = options['window_size'],
-                          step_size   = options['step_size'],
-                          batch_size  = options['batch_size'])
-    dev_data   = DataIter(text_file  = args.data_dir + '/dev',
+                          batch_size  = options['batch_size'],
+                          mmap        = args.mmap)
+    test_data  = EvalIter(text_file   = args.data_dir + '/test',
                           window_size = options['window_size'],
-                          step_size   = options['step_size'],
-                          batch_size  = options['batch_size'])
-    test_data  = DataIter(text_file  = args.data_dir + '/test',
-                          window_size = options['window_size'],
-                          step_size   = options['step_size'],
-                          batch_size  = options['batch_size'])
+                          batch_size  = options['batch_size'],
+                          mmap        = args.mmap)
 
     """
     Print summary for logging 
@@ -134,6 +167,9 @@ def main():
     def print_hline(): print(''.join('-' for _ in range(79)))
     lapse_from = lambda start: ('(' + ('%.1f' % (time.time() - start)).rjust(7)
                                 + ' sec)')
+    wait_of = lambda data_iter: (' (data wait %.1f sec)'
+                                 % data_iter.wait_time()
+                                 if args.prefetch > 0 else '')
 
     print_hline() # -----------------------------------------------------------
     print('Data location : ' + args.data_dir)
@@ -152,8 +188,13 @@ def main():
     print('    np.random.seed : ' + str(seed).rjust(10))
     print('    train set size : ' + str(train_data.size()).rjust(10))
     print('    dev   set size : ' + str(dev_data  .size()).rjust(10))
+    for name in ['train', 'dev']: # n-gram entropy baselines (cached)
+        h = ngram_entropies(get_stats(args.data_dir + '/' + name))
+        print('    ' + name.ljust(5) + ' 1/2/3-gram bpc : '
+              + ' / '.join('%.3f' % e for e in h))
     print('    # of weights   : ', end = '')
-    net = Net(options, args.save_to, args.load_from, c_names) # takes few secs
+    net = Net(options, args.save_to, args.load_from, c_names, # takes few secs
+              fused_update = args.fused_update, async_save = True)
     print(str(net.n_weights()).rjust(10))
 
 
@@ -164,13 +205,17 @@ def main():
     print_hline() # -----------------------------------------------------------
     print('Compiling fwd/bwd propagators... ', end = '') # takes minutes ~ 
     start = time.time()                                  # hours (unroll_scan)
-    f_fwd_bwd_propagate = net.compile_f_fwd_bwd_propagate()
+    if args.fused_update: # with parameter updates
+        f_fwd_bwd_update    = net.compile_f_fwd_bwd_update()
+    else:
+        f_fwd_bwd_propagate = net.compile_f_fwd_bwd_propagate()
     f_fwd_propagate     = net.compile_f_fwd_propagate()
     print(lapse_from(start))
 
     print('Compiling updater/initializer... ', end = '')
     start = time.time()
-    f_update_v_params = net.compile_f_update_v_params()
+    if not args.fused_update:
+        f_update_v_params = net.compile_f_update_v_params()
     f_initialize_optimizer = net.compile_f_initialize_optimizer()
     print(lapse_from(start))
 
@@ -200,7 +245,10 @@ def main():
         frames_seen = 0
 
         for input_tbi, target_tbi in data_iter:
-            if is_training:
+            if is_training and args.fused_update:
+                loss = f_fwd_bwd_update(input_tbi, target_tbi, step_size,
+                                        lr_cur)
+            elif is_training:
                 loss = f_fwd_bwd_propagate(input_tbi, target_tbi, step_size)
             else:
                 loss = f_fwd_propagate(input_tbi, target_tbi, step_size)
@@ -208,12 +256,26 @@ def main():
             loss_sum    += np.asscalar(loss[0])
             frames_seen += frames_per_step
             
-            if is_training:
+            if is_training and not args.fused_update:
                 f_update_v_params(lr_cur)
             
             if frames_seen >= trained_frames_per_epoch:
                 break
         return np.float32(loss_sum / frames_seen)
+
+    def run_eval(eval_iter):
+        """
+        Inference over one full pass of an EvalIter
+        """
+        loss_sum = 0.
+
+        for input_tbi, target_tbi, step_size, reset in eval_iter:
+            if reset: # from zero states, regardless of training before
+                net.reset_prev_states()
+            loss = f_fwd_propagate(input_tbi, target_tbi, step_size)
+            loss_sum += np.asscalar(loss[0])
+
+        return np.float32(loss_sum / eval_iter.n_frames())
     
 
     """
@@ -221,7 +283,7 @@ def main():
     Adapted from https://github.com/KyuyeonHwang/Fractal
     """
 
-    # Names for saving/loading
+    # Names for snapshots (kept in host memory; only best is saved to file)
     name_pivot = '0'
     name_prev  = '1'
     name_best  = None # auto
@@ -240,21 +302,22 @@ def main():
     lr = options['lr_init_val']
     f_initialize_optimizer()
 
-    net.save_to_workspace(name_prev)
-    net.save_to_workspace(name_best)
+    net.snapshot(name_prev)
+    net.snapshot(name_best)
+    net.save_to_workspace(name_best, from_snapshot = True)
 
     while True:
         print_hline() # -------------------------------------------------------
         print('Training...   ', end = '')
         start = time.time()
         loss_train = run_epoch(train_data, lr)
-        print(lapse_from(start))
+        print(lapse_from(start) + wait_of(train_data))
 
         trained_frames += trained_frames_per_epoch
 
         print('Evaluating... ', end = '')
         start = time.time()
-        loss_cur = run_epoch(dev_data, None)
+        loss_cur = run_eval(dev_data)
         print(lapse_from(start))
 
         print('Total trained frames   : ' + str(trained_frames  ).rjust(12))
@@ -266,11 +329,15 @@ def main():
             loss_cur = np.float32('inf')
         
         if loss_cur < loss_best or trained_frames == trained_frames_per_epoch:
-            print(' (best)', end = '')
-
             trained_frames_at_best = trained_frames
             loss_best = loss_cur
-            net.save_to_workspace(name_best)
+
+            # file is written in background; only the host copy stalls
+            start = time.time()
+            net.snapshot(name_best)
+            net.save_to_workspace(name_best, from_snapshot = True)
+            print(' (best; checkpoint stall %.2f sec)' % (time.time() - start),
+                  end = '')
         print('')
 
         if loss_cur > loss_prev and trained_frames > trained_frames_per_epoch:
@@ -289,12 +356,12 @@ def main():
                 discard = trained_frames - trained_frames_at_pivot
                 discarded_frames += discard
                 trained_frames = trained_frames_at_pivot
-                net.load_from_workspace(name_pivot)
+                net.restore(name_pivot)
                 
                 f_initialize_optimizer()
 
                 loss_prev = loss_pivot
-                net.save_to_workspace(name_prev)
+                net.snapshot(name_prev)
 
                 print('Discard recently trained ' + str(discard) + ' frames')
                 print('New learning rate : ' + str(lr))
@@ -311,23 +378,25 @@ def main():
             loss_pivot, loss_prev = loss_prev, loss_cur
             name_pivot, name_prev = name_prev, name_pivot
 
-            net.save_to_workspace(name_prev)
+            net.snapshot(name_prev)
     
 
     discarded_frames += trained_frames - trained_frames_at_best
     trained_frames = trained_frames_at_best
-    net.load_from_workspace(name_best)
+    net.restore(name_best)
 
-    net.remove_from_workspace(name_pivot)
-    net.remove_from_workspace(name_prev)
+    net.drop_snapshot(name_pivot)
+    net.drop_snapshot(name_prev)
+    net.flush_workspace()
 
     print('')
     print('Best network')
     print('Total trained frames   : ' + str(trained_frames  ).rjust(12))
     print('Total discarded frames : ' + str(discarded_frames).rjust(12))
     print('[Train] loss : %.6f' % run_epoch(train_data, None))
-    print('[Dev]   loss : %.6f' % run_epoch(dev_data  , None))
-    print('[Test]  loss : %.6f' % run_epoch(test_data , None))
+    for name, eval_iter in [('[Dev]  ', dev_data), ('[Test] ', test_data)]:
+        loss = run_eval(eval_iter)
+        print(name + ' loss : %.6f (%.4f bpc)' % (loss, loss / np.log(2.)))
     print('')
 
 if __name__ == '__main__':